@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from nested_filestore import NestedFilestore
+from nested_filestore.index import Index
+
+
+def percentiles(samples_ns):
+    "summarize latency samples in microseconds"
+    samples = sorted(samples_ns)
+    if not samples:
+        return None
+
+    def pick(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] / 1000
+
+    return {
+        "count": len(samples),
+        "mean_us": sum(samples) / len(samples) / 1000,
+        "p50_us": pick(0.50),
+        "p90_us": pick(0.90),
+        "p99_us": pick(0.99),
+        "max_us": samples[-1] / 1000,
+    }
+
+
+def peak_rss_bytes():
+    "peak resident set size of this process; ru_maxrss is in kilobytes on Linux and bytes on macOS"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_store(path, hierarchy, items, payload_size, compacted_ratio, codec, workers, seed, storage="files"):
+    "create a synthetic store with identifiers 0..items-1 and compact a fraction of its full groups"
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    rng = random.Random(seed)
+
+    # a pool of distinct payloads, reused round-robin
+    payload_dir = tempfile.mkdtemp(prefix="nested-filestore-payloads-")
+    payloads = []
+    for n in range(16):
+        filename = os.path.join(payload_dir, f"{n}.bin")
+        with open(filename, "wb") as f:
+            f.write(rng.randbytes(payload_size))
+        payloads.append(filename)
+
+    filestore = NestedFilestore(path, hierarchy, storage=storage)
+    start = time.perf_counter()
+    result = filestore.put_many(
+        ((identifier, payloads[identifier % len(payloads)]) for identifier in range(items)),
+        workers=workers,
+    )
+    put_seconds = time.perf_counter() - start
+    shutil.rmtree(payload_dir)
+    if not result.ok:
+        raise click.ClickException(f"could not generate store: {result}")
+
+    # compact the first groups, up to the requested fraction of all groups
+    index = filestore.index
+    full_groups = sorted(uri for uri, group in index.groups.items() if group.is_full)
+    to_compact = [index.groups[uri] for uri in full_groups[:int(round(compacted_ratio * len(index.groups)))]]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(lambda group: group.timed_compact(codec=codec), to_compact))
+    compact_seconds = time.perf_counter() - start
+    index.sync()
+    index.save()
+
+    return {
+        "put": {
+            "items": items,
+            "seconds": put_seconds,
+            "items_per_second": items / put_seconds if put_seconds else None,
+            "bytes_per_second": items * payload_size / put_seconds if put_seconds else None,
+        },
+        "compact": {
+            "groups": len(reports),
+            "items": sum(report.items for report in reports),
+            "archive_bytes": sum(report.size for report in reports),
+            "seconds": compact_seconds,
+            "items_per_second": sum(report.items for report in reports) / compact_seconds if reports else None,
+        },
+    }
+
+
+def measure_startup(path, hierarchy, repeat):
+    "time Index construction with the manifest, and a full sync without it"
+    results = dict()
+    for name, manifest in [("manifest", True), ("full_sync", False)]:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            Index(path=path, dimensions=hierarchy, manifest=manifest)
+            samples.append(time.perf_counter_ns() - start)
+        results[name] = percentiles(samples)
+    return results
+
+
+def measure_lookups(path, hierarchy, items, lookups, seed):
+    "time exists() and get() for random identifiers, splitting reads by loose, segment and tarball items"
+    rng = random.Random(seed)
+    filestore = NestedFilestore(path, hierarchy)
+
+    exists_hit, exists_miss = [], []
+    for _ in range(lookups):
+        identifier = rng.randrange(items * 2)
+        start = time.perf_counter_ns()
+        found = filestore.exists(identifier)
+        elapsed = time.perf_counter_ns() - start
+        (exists_hit if found else exists_miss).append(elapsed)
+
+    gets = {"loose": [], "segment": [], "tarball": []}
+    for _ in range(lookups):
+        identifier = rng.randrange(items)
+        start = time.perf_counter_ns()
+        item = filestore.index.get(identifier)
+        with item.open() as f:
+            f.read()
+        elapsed = time.perf_counter_ns() - start
+        gets[item.storage].append(elapsed)
+
+    filestore.close()
+    return {
+        "exists_hit": percentiles(exists_hit),
+        "exists_miss": percentiles(exists_miss),
+        "get_loose": percentiles(gets["loose"]),
+        "get_segment": percentiles(gets["segment"]),
+        "get_tarball": percentiles(gets["tarball"]),
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--hierarchy', default="3,3,3", help="comma-separated hierarchy order, leaf first")
+@click.option('--items', type=int, default=20000, help="number of identifiers to store")
+@click.option('--payload-size', type=int, default=256, help="bytes per item")
+@click.option('--compacted-ratio', type=float, default=0.5, help="fraction of groups to compact")
+@click.option('--codec', default="gzip", help="codec for compacted groups")
+@click.option('--storage', type=click.Choice(["files", "segment"]), default="files", help="layout of groups that are not compacted")
+@click.option('--lookups', type=int, default=2000, help="number of timed exists() and get() calls")
+@click.option('--repeat', type=int, default=5, help="number of timed startups")
+@click.option('--workers', type=int, default=4, help="threads for put_many and compact")
+@click.option('--seed', type=int, default=0)
+@click.option('--path', default=None, help="where to generate the store; a temporary directory by default")
+@click.option('--output', default=None, help="write results to this JSON file instead of stdout")
+def run(hierarchy, items, payload_size, compacted_ratio, codec, storage, lookups, repeat, workers, seed, path, output):
+    "Generate a synthetic store and measure it"
+    hierarchy = [int(level) for level in hierarchy.split(",")]
+    cleanup = path is None
+    path = path or tempfile.mkdtemp(prefix="nested-filestore-bench-")
+
+    try:
+        results = {
+            "params": {
+                "hierarchy": hierarchy,
+                "items": items,
+                "payload_size": payload_size,
+                "compacted_ratio": compacted_ratio,
+                "codec": codec,
+                "storage": storage,
+                "lookups": lookups,
+                "repeat": repeat,
+                "workers": workers,
+                "seed": seed,
+            },
+            "environment": {
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": time.time(),
+            },
+        }
+        results.update(generate_store(path, hierarchy, items, payload_size, compacted_ratio, codec, workers, seed, storage))
+        results["startup"] = measure_startup(path, hierarchy, repeat)
+        results["lookups"] = measure_lookups(path, hierarchy, items, lookups, seed)
+        results["peak_rss_bytes"] = peak_rss_bytes()
+    finally:
+        if cleanup:
+            shutil.rmtree(path, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+def flatten(results, prefix=""):
+    "flatten nested numeric results into dotted keys"
+    flat = dict()
+    for key, value in results.items():
+        if key in ("params", "environment"):
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+@cli.command()
+@click.argument('baseline', type=click.File("r"))
+@click.argument('candidate', type=click.File("r"))
+def compare(baseline, candidate):
+    "Compare two result files, printing the relative change of every metric"
+    baseline = json.load(baseline)
+    candidate = json.load(candidate)
+    if baseline["params"] != candidate["params"]:
+        print("warning: results were produced with different parameters")
+
+    before = flatten(baseline)
+    after = flatten(candidate)
+    width = max(len(name) for name in before)
+    for name, value in before.items():
+        if name not in after:
+            continue
+        change = (after[name] - value) / value * 100 if value else 0.0
+        print(f"{name:<{width}}  {value:>14.3f}  {after[name]:>14.3f}  {change:+7.1f}%")
+
+
+if __name__ == "__main__":
+    cli()
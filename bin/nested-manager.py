@@ -2,12 +2,15 @@
 
 import os
 import json
+import time
 import random
 import logging
 
 import click
 
 from nested_filestore import NestedFilestore
+from nested_filestore.archive import CODECS, codec_available
+from nested_filestore.blobs import BLOB_DIRECTORY, BlobStore
 
 
 @click.group()
@@ -22,47 +25,217 @@ def upgrade_to_tarball(filestore):
         root_path=os.path.expanduser(filestore),
         hierarchy_order=[3, 3, 3],
     )
-    filestore.tarball_scan()
+    filestore.compact()
 
 @cli.command()
 @click.argument('filestore', type=str)
-def validate(filestore):
+@click.option('--workers', type=int, default=os.cpu_count(), help="number of groups to compact at once")
+@click.option('--codec', type=click.Choice(list(CODECS)), default="gzip", help="tarball compression")
+@click.option('--level', type=int, default=None, help="compression level")
+@click.option('--locking/--no-locking', default=False, help="lock groups so other processes can write at the same time")
+@click.option('--dedup/--no-dedup', default=False, help="store identical items once in each tarball and remove unreferenced blobs")
+def compact(filestore, workers, codec, level, locking, dedup):
+    "Compact every full group into a tarball"
+    if not codec_available(codec):
+        raise click.ClickException(f"the library for codec {codec} is not installed")
+    filestore = NestedFilestore(
+        root_path=os.path.expanduser(filestore),
+        hierarchy_order=[3, 3, 3],
+        locking=locking,
+        dedup=dedup,
+    )
+
+    def progress(report):
+        if not report.ok:
+            print(f"{report.group} failed: {report.error}")
+            return
+        print(f"{report.group} {report.items} items, {report.size} bytes in {report.seconds:.2f}s ({report.bytes_per_second / 1e6:.1f} MB/s)")
+
+    start = time.perf_counter()
+    reports = filestore.compact(codec=codec, compresslevel=level, workers=workers, progress=progress)
+    seconds = time.perf_counter() - start
+    compacted = [report for report in reports if report.ok]
+    total_size = sum(report.size for report in compacted)
+    print(f"Compacted {len(compacted)} groups, {total_size} bytes in {seconds:.2f}s")
+    if len(compacted) < len(reports):
+        print(f"{len(reports) - len(compacted)} groups failed")
+    if dedup:
+        print(f"Shared members saved {filestore.index.blobs.stats['archive_bytes_saved']} bytes")
+
+@cli.command()
+@click.argument('filestore', type=str)
+@click.option('--workers', type=int, default=os.cpu_count(), help="number of groups to recompress at once")
+@click.option('--codec', type=click.Choice(list(CODECS)), required=True, help="new tarball compression")
+@click.option('--level', type=int, default=None, help="compression level")
+@click.option('--from', 'source_codecs', type=click.Choice(list(CODECS)), multiple=True, help="only rewrite groups using this codec; may be repeated")
+def recompress(filestore, workers, codec, level, source_codecs):
+    "Rewrite compacted groups with another codec or compression level"
+    if not codec_available(codec):
+        raise click.ClickException(f"the library for codec {codec} is not installed")
+    filestore = NestedFilestore(
+        root_path=os.path.expanduser(filestore),
+        hierarchy_order=[3, 3, 3],
+    )
+
+    def progress(report):
+        print(f"{report.group} {report.size} bytes in {report.seconds:.2f}s ({report.bytes_per_second / 1e6:.1f} MB/s)")
+
+    start = time.perf_counter()
+    reports = filestore.recompress(
+        codec=codec,
+        compresslevel=level,
+        workers=workers,
+        progress=progress,
+        source_codecs=source_codecs or None,
+    )
+    seconds = time.perf_counter() - start
+    total_size = sum(report.size for report in reports)
+    print(f"Recompressed {len(reports)} groups to {codec}, {total_size} bytes in {seconds:.2f}s")
+
+@cli.command()
+@click.argument('filestore', type=str)
+@click.option('--quick', is_flag=True, help="only check member counts and sizes, without reading the members")
+@click.option('--workers', type=int, default=os.cpu_count(), help="number of groups to validate at once")
+def validate(filestore, quick, workers):
     "Check the index for validity"
     filestore = NestedFilestore(
         root_path=os.path.expanduser(filestore),
         hierarchy_order=[3, 3, 3],
     )
 
-    bad_groups = []
-    for group_uri in filestore.index.groups:
-        group = filestore.index.get_group(group_uri)
-        validation_result = group.validate(debug=True)
-        group.close()
-        if validation_result is True:
-            print(f"{group_uri} valid")
+    def progress(group, result):
+        if result is True:
+            print(f"{group.uri} valid")
         else:
-            bad_groups.append(group_uri)
-            print(f"{group_uri} invalid: {validation_result}")
-    
-    if len(bad_groups) > 0:
+            print(f"{group.uri} invalid: {result}")
+
+    result = filestore.index.validate(quick=quick, workers=workers, progress=progress)
+    if result is not True:
         print("Bad groups:")
-        for group_uri in bad_groups:
+        for group_uri in result:
             print(f"  {group_uri}")
     else:
         print("Index is valid")
 
 
+@cli.command()
+@click.argument('filestore', type=str)
+def reindex(filestore):
+    "Rescan every group and rewrite the index manifest"
+    filestore = NestedFilestore(
+        root_path=os.path.expanduser(filestore),
+        hierarchy_order=[3, 3, 3],
+    )
+    filestore.index.sync()
+    filestore.index.save()
+    print(f"Indexed {len(filestore.index.groups)} groups")
+
+@cli.command()
+@click.argument('filestore', type=str)
+@click.option('--start', type=int, default=None, help="first identifier to check; defaults to the lowest stored")
+@click.option('--stop', type=int, default=None, help="identifier to stop before; defaults to one past the highest stored")
+def missing(filestore, start, stop):
+    "Print the ranges of missing identifiers as start and stop (exclusive)"
+    filestore = NestedFilestore(
+        root_path=os.path.expanduser(filestore),
+        hierarchy_order=[3, 3, 3],
+    )
+
+    total = 0
+    for range_start, range_stop in filestore.index.missing_ranges(start, stop):
+        print(f"{range_start}\t{range_stop}")
+        total += range_stop - range_start
+    print(f"{total} identifiers missing")
+
+@cli.command()
+@click.argument('filestore', type=str)
+@click.option('--lookups', type=int, default=1000, help="number of random exists() calls")
+@click.option('--reads', type=int, default=1000, help="number of random items to read")
+@click.option('--seed', type=int, default=0)
+@click.option('--json', 'as_json', is_flag=True, help="print the statistics as JSON")
+def stats(filestore, lookups, reads, seed, as_json):
+    "Load the index, run a random lookup and read workload, and print where the time went"
+    filestore = NestedFilestore(
+        root_path=os.path.expanduser(filestore),
+        hierarchy_order=[3, 3, 3],
+        metrics=True,
+    )
+    index = filestore.index
+    rng = random.Random(seed)
+
+    if index.groups:
+        low, high = int(index.min), int(index.max)
+        for _ in range(lookups):
+            index.exists(rng.randint(low, high))
+        read = 0
+        for _ in range(reads * 10):
+            if read >= reads:
+                break
+            identifier = rng.randint(low, high)
+            if index.exists(identifier):
+                with index.get(identifier).open() as f:
+                    f.read()
+                read += 1
+
+    summary = index.stats
+    if os.path.isdir(os.path.join(index.path, BLOB_DIRECTORY)):
+        summary["blobs"] = BlobStore(index.path).usage()
+    filestore.close()
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    for name, timer in summary["metrics"]["timers"].items():
+        print(f"{name:<20} {timer['count']:>8} calls  {timer['mean_seconds'] * 1e6:>10.1f} us mean  {timer['max_seconds'] * 1e6:>10.1f} us max  {timer['total_seconds']:>8.3f} s total")
+    for name, value in summary["metrics"]["counters"].items():
+        print(f"{name:<20} {value:>8}")
+    handles = summary["handles"]
+    print(f"tarball handles      {handles['hits']} hits, {handles['misses']} opens, {handles['evictions']} evictions")
+    if "blobs" in summary:
+        usage = summary["blobs"]
+        print(f"dedup blobs          {usage['blobs']} blobs, {usage['bytes']} bytes, {usage['references']} items, {usage['bytes_saved']} bytes saved")
+
+@cli.command()
+@click.argument('filestore', type=str)
+@click.argument('output', type=str)
+@click.option('--start', type=int, required=True, help="first identifier to export")
+@click.option('--stop', type=int, required=True, help="identifier to stop before")
+@click.option('--readahead', type=int, default=1, help="number of groups to read ahead")
+def export(filestore, output, start, stop, readahead):
+    "Export a range of items to one data file with numpy offsets and missing arrays"
+    filestore = NestedFilestore(
+        root_path=os.path.expanduser(filestore),
+        hierarchy_order=[3, 3, 3],
+        sync="lazy",
+    )
+    summary = filestore.export_range(start, stop, os.path.expanduser(output), readahead=readahead)
+    seconds = summary["seconds"]
+    print(f"Exported {summary['items']} items, {summary['bytes']} bytes in {seconds:.2f}s ({summary['missing']} missing)")
+
 @cli.command()
 @click.argument('input_filestore', type=str)
 @click.argument('output_filestore', type=str)
-def ingest(input_filestore, output_filestore):
+@click.option('--workers', type=int, default=8, help="number of copy threads")
+@click.option('--locking/--no-locking', default=False, help="lock groups so several ingest processes can share the output")
+@click.option('--dedup/--no-dedup', default=False, help="store identical items once, as hard links to a shared blob")
+def ingest(input_filestore, output_filestore, workers, locking, dedup):
     "Import a NestedFilestore into a NestedFilestore"
     filestore = NestedFilestore(
         root_path=os.path.expanduser(output_filestore),
         hierarchy_order=[3, 3, 3],
+        locking=locking,
+        dedup=dedup,
     )
-    filestore.ingest_filesystem(input_filestore)
-    filestore.tarball_scan()
+    result = filestore.ingest_filesystem(os.path.expanduser(input_filestore), workers=workers)
+    print(f"Ingested {len(result.succeeded)} files, {len(result.conflicts)} conflicts, {len(result.failures)} failures")
+    for identifier, error in result.failures.items():
+        print(f"  {identifier}: {error}")
+    if dedup:
+        stats = filestore.index.blobs.stats
+        print(f"Deduplicated {stats['duplicates']} files, saving {stats['bytes_saved']} bytes")
+    filestore.compact(workers=workers)
+    if locking:
+        print(f"Lock waits: {filestore.index.locks.stats}")
 
 if __name__ == "__main__":
     # init_logger(level=os.getenv("LOG_LEVEL", "INFO"))
@@ -5,6 +5,10 @@ import shutil
 
 
 from .index import Index
+from .aio import AsyncNestedFilestore
+from .cache import ReadCache
+from .prefetch import Prefetcher
+from .export import ExportedRange
 
 
 class NestedFilestore:
@@ -13,14 +17,23 @@ class NestedFilestore:
     This is a thin wrapper around the Index class.
     """
 
-    def __init__(self, root_path, hierarchy_order, pad_character="0", base=10):
-        "args are root filesystem path, and order of hierarchy starting from leaf back to the root"
+    def __init__(self, root_path, hierarchy_order, pad_character="0", base=10, fsync="none", max_open_tarballs=64, sync=True, locking=False, metrics=False, read_cache=None, storage="files", dedup=False):
+        "args are root filesystem path, and order of hierarchy starting from leaf back to the root; fsync is none, file or dir; sync=\"lazy\" loads groups on first use; locking=True makes writers and compaction safe across processes; metrics=True records timings in index.metrics; read_cache is a ReadCache for items in compacted groups; storage=\"segment\" appends the items of new groups to one segment file per group; dedup=True stores identical payloads once"
         self.index = Index(
             path=root_path,
             dimensions=hierarchy_order,
             pad_character=pad_character,
             base=base,
+            fsync=fsync,
+            max_open_tarballs=max_open_tarballs,
+            sync=sync,
+            locking=locking,
+            metrics=metrics,
+            read_cache=read_cache,
+            storage=storage,
+            dedup=dedup,
         )
+        self.prefetcher = None
 
     def exists(self, identifier):
         "does the specified identifier exist as a file? If it exists, return True"
@@ -36,8 +49,17 @@ class NestedFilestore:
             overwrite=overwrite
         )
 
+    def put_many(self, sources, move=False, overwrite=False, workers=8):
+        "given (identifier, filename) pairs, copy or move the files into the file store on a thread pool; returns a BulkPutResult"
+        return self.index.put_many(
+            sources,
+            move=move,
+            overwrite=overwrite,
+            workers=workers
+        )
+
     def writer(self, identifier, overwrite=False):
-        "given an identifier, return a writable file handle pointing to the file UNLESS it exists"
+        "given an identifier, return a writable file handle UNLESS it exists; the file appears in the store when the handle is closed"
         return self.index.put(
             identifier,
             filehandle=True,
@@ -46,14 +68,82 @@ class NestedFilestore:
     
     def get(self, identifier):
         "given an identifier, return a file handle pointing to the file if it exists"
-        return self.index.get(identifier).open()
+        f = self.index.get(identifier).open()
+        if self.prefetcher is not None:
+            # after the read is served, so warming does not hold it up
+            self.prefetcher.observe(identifier)
+        return f
+
+    def get_buffer(self, identifier):
+        "given an identifier, return a read-only memoryview of its contents without copying them where possible"
+        buffer = self.index.get(identifier).buffer()
+        if self.prefetcher is not None:
+            self.prefetcher.observe(identifier)
+        return buffer
+
+    def iter_range(self, start, stop, *, include_missing=False, readahead=1):
+        "yield (identifier, bytes) for stored identifiers in [start, stop) in order, streaming each group once"
+        return self.index.iter_range(start, stop, include_missing=include_missing, readahead=readahead)
+
+    def export_range(self, start, stop, path, readahead=1):
+        "write the items of [start, stop) to the directory path as data.bin, offsets.npy and missing.npy, for ExportedRange or numpy to map; returns a summary"
+        return self.index.export_range(start, stop, path, readahead=readahead)
+
+    def exists_many(self, identifiers):
+        "given many identifiers, yield (identifier, exists) pairs in request order"
+        return self.index.exists_many(identifiers)
+
+    def get_many(self, identifiers, ordered=True):
+        "given many identifiers, yield (identifier, bytes) pairs, reading each group once; missing identifiers yield None"
+        return self.index.get_many(identifiers, ordered=ordered)
 
-    def ingest_filesystem(self, filestore_path):
-        "low-level filesystem scan of filestore_path for .bin files, which it imports"
+    def compact(self, codec="gzip", compresslevel=None, workers=1, progress=None):
+        "compact every full group into a tarball on a pool of workers; returns a list of CompactionReports"
+        return self.index.compact(
+            codec=codec,
+            compresslevel=compresslevel,
+            workers=workers,
+            progress=progress
+        )
+
+    def recompress(self, codec="gzip", compresslevel=None, workers=1, progress=None, source_codecs=None):
+        "rewrite compacted groups with another codec or level; returns a list of CompactionReports"
+        return self.index.recompress(
+            codec=codec,
+            compresslevel=compresslevel,
+            workers=workers,
+            progress=progress,
+            source_codecs=source_codecs
+        )
+
+    def watch(self, backend="auto", interval=1.0):
+        "keep the index current with changes other processes make, using inotify or polling; returns the Watcher"
+        return self.index.watch(backend=backend, interval=interval)
 
+    def prefetch(self, depth=2, max_bytes=256 * 1024 * 1024, workers=2):
+        "warm the next depth groups in the background while get() and get_buffer() read identifiers in ascending order; returns the Prefetcher"
+        if self.prefetcher is None:
+            self.prefetcher = Prefetcher(self.index, depth=depth, max_bytes=max_bytes, workers=workers)
+        return self.prefetcher
+
+    def ingest_filesystem(self, filestore_path, workers=8):
+        "low-level filesystem scan of filestore_path for .bin files, which it moves into the file store; returns a BulkPutResult"
+
+        sources = []
         file_list = glob.glob(os.path.join(filestore_path, "**/*.bin"), recursive=True)
         for filename in sorted(file_list):
             match = re.search(r'([^/]+).bin', filename)
             if match:
                 index = int(match.group(1))
-                self.put(index, filename=filename, move=True)
+                sources.append((index, filename))
+
+        result = self.put_many(sources, move=True, workers=workers)
+        self.index.save()
+        return result
+
+    def close(self):
+        "stop prefetching, close open tarballs and persist the index manifest"
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        self.index.close()
@@ -0,0 +1,144 @@
+import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncReader:
+    "asynchronous wrapper around a readable file, running each call on the filestore executor"
+
+    def __init__(self, filestore, fh):
+        self._filestore = filestore
+        self._fh = fh
+
+    async def read(self, size=-1):
+        return await self._filestore._run(self._fh.read, size)
+
+    async def seek(self, offset, whence=0):
+        return await self._filestore._run(self._fh.seek, offset, whence)
+
+    async def close(self):
+        await self._filestore._run(self._fh.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncWriter:
+    "asynchronous wrapper around an AtomicWriter; the item appears in the store when it is closed"
+
+    def __init__(self, filestore, fh):
+        self._filestore = filestore
+        self._fh = fh
+
+    async def write(self, data):
+        return await self._filestore._run(self._fh.write, data)
+
+    async def close(self):
+        await self._filestore._run(self._fh.close)
+
+    async def discard(self):
+        await self._filestore._run(self._fh.discard)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.discard()
+
+
+class AsyncNestedFilestore:
+    """
+    AsyncNestedFilestore serves a NestedFilestore to asyncio code.
+    Blocking filesystem and tarball work, including index lookups, runs on a bounded thread pool, and puts are serialized per group.
+    It shares the Index of the given NestedFilestore, so sync and async callers see the same items.
+    """
+
+    def __init__(self, filestore, max_workers=8, retries=3, retry_delay=0.1):
+        self.filestore = filestore
+        self.index = filestore.index
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nested-filestore")
+        # group uri -> [lock, number of puts holding or waiting for it]
+        self._group_locks = dict()
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+    @asynccontextmanager
+    async def _group_lock(self, identifier):
+        "hold the lock of the group of identifier, dropping it once no put holds or waits for it"
+        group_uri = self.index.which_group(str(identifier))
+        entry = self._group_locks.setdefault(group_uri, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._group_locks[group_uri]
+
+    async def exists(self, identifier):
+        "does the specified identifier exist as a file? If it exists, return True"
+        return await self._run(self.index.exists, identifier)
+
+    async def get(self, identifier):
+        "given an identifier, return an AsyncReader for the file if it exists"
+        item = await self._run(self.index.get, identifier)
+        for attempt in range(self.retries + 1):
+            try:
+                fh = await self._run(item.open)
+                return AsyncReader(self, fh)
+            except FileNotFoundError:
+                if attempt == self.retries:
+                    raise
+                # the group may have been compacted since it was indexed
+                self.index.metrics.count("aio.get.retries")
+                await self._run(item.group.redetect)
+                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+
+    async def put(self, identifier, filename=None, move=False, overwrite=False):
+        "given the path to an existing file, and given an identifier, copy the file to the file store"
+        async with self._group_lock(identifier):
+            return await self._run(
+                self.filestore.put,
+                identifier,
+                filename=filename,
+                move=move,
+                overwrite=overwrite
+            )
+
+    async def writer(self, identifier, overwrite=False):
+        "given an identifier, return an AsyncWriter UNLESS it exists"
+        async with self._group_lock(identifier):
+            fh = await self._run(self.filestore.writer, identifier, overwrite=overwrite)
+        return AsyncWriter(self, fh)
+
+    async def get_many(self, identifiers, ordered=True):
+        "given many identifiers, asynchronously yield (identifier, bytes) pairs, reading each group once"
+        results = self.index.get_many(identifiers, ordered=ordered)
+        done = object()
+        while True:
+            result = await self._run(next, results, done)
+            if result is done:
+                break
+            yield result
+
+    async def close(self):
+        "wait for pending work and release the executor; the shared index stays open"
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,493 @@
+import io
+import os
+import sys
+import json
+import mmap
+import stat
+import hashlib
+import time
+import zlib
+import tarfile
+import threading
+from contextlib import redirect_stdout
+
+import ratarmountcore as rmc
+
+
+# compacted group formats, by codec name and file extension
+# zstd and lz4 compress each member separately inside a plain tar, so members stay addressable by offset
+CODECS = {
+    "none": ".tar",
+    "gzip": ".tgz",
+    "zstd": ".zst.tar",
+    "lz4": ".lz4.tar",
+}
+# match the longest extension first, so .zst.tar is not taken for .tar
+EXTENSIONS = {extension: codec for codec, extension in sorted(CODECS.items(), key=lambda entry: -len(entry[1]))}
+
+# suffix added to the names of members compressed by a per-member codec
+MEMBER_SUFFIXES = {
+    "zstd": ".zst",
+    "lz4": ".lz4",
+}
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# redirect_stdout swaps a process-wide object, so concurrent opens must not interleave
+_stdout_lock = threading.Lock()
+
+
+def archive_codec(filename):
+    "return the codec for a compacted group filename, or None if it is not an archive"
+    for extension, codec in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return codec
+    return None
+
+
+def codec_available(codec):
+    "whether codec is known and its library can be imported"
+    if codec not in CODECS:
+        return False
+    try:
+        _codec_module(codec)
+    except ImportError:
+        return False
+    return True
+
+
+def _codec_module(codec):
+    if codec == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("the zstd codec requires zstandard; install nested-filestore[zstd]") from e
+        return zstandard
+    if codec == "lz4":
+        try:
+            import lz4.frame
+        except ImportError as e:
+            raise ImportError("the lz4 codec requires lz4; install nested-filestore[lz4]") from e
+        return lz4.frame
+    return None
+
+
+def compress(codec, data, level=None):
+    "compress one member with a per-member codec"
+    module = _codec_module(codec)
+    if codec == "zstd":
+        return module.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if codec == "lz4":
+        return module.compress(data, compression_level=0 if level is None else level)
+    return data
+
+
+def decompress(codec, data):
+    "decompress one member written by compress()"
+    module = _codec_module(codec)
+    if codec == "zstd":
+        return module.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        return module.decompress(data)
+    return data
+
+
+def member_identifier(name):
+    "convert an archive member name like 0/1/11.bin or 0/1/11.bin.zst to its identifier"
+    basename = name.rsplit("/", 1)[-1]
+    for suffix in MEMBER_SUFFIXES.values():
+        if basename.endswith(suffix):
+            basename = basename[:-len(suffix)]
+            break
+    if not basename.endswith(".bin"):
+        return None
+    return basename[:-len(".bin")]
+
+
+def open_archive(path, prefix):
+    "open a compacted group, choosing the reader from the file contents rather than its extension"
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return RatarmountArchive(path, prefix)
+    # a .tgz that is not gzipped is read as a plain tar
+    codec = archive_codec(path)
+    return IndexedTar(path, codec if codec in MEMBER_SUFFIXES else "none")
+
+
+class _Checksummed:
+    "file wrapper computing the crc32 and length of everything read through it"
+
+    def __init__(self, f):
+        self._f = f
+        self.crc32 = 0
+        self.length = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.length += len(data)
+        return data
+
+
+def write_archive(path, prefix, sources, codec="gzip", compresslevel=None, dedup=False):
+    """
+    write a compacted group to path from (identifier, source) pairs, where source is a filename or bytes.
+    returns (members, checksums): identifier to the (offset, size) of its stored member,
+    and identifier to the (length, crc32) of its original contents.
+    with dedup, a source identical to an earlier one is stored as a tar hard link to it, and shares its offset:
+    filenames are identical when they are links to the same file, and bytes when their sha256 matches.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"unknown codec {codec}, expected one of {', '.join(CODECS)}")
+    _codec_module(codec)
+
+    options = dict()
+    if codec == "gzip" and compresslevel is not None:
+        options["compresslevel"] = compresslevel
+    suffix = MEMBER_SUFFIXES.get(codec, "")
+
+    members = dict()
+    checksums = dict()
+    stored = dict()
+    with tarfile.open(path, mode="w:gz" if codec == "gzip" else "w", **options) as tarball:
+        # loose items may be hard links to one blob; only the dedup branch below may store link members
+        tarball.dereference = True
+        for identifier, source in sources:
+            arcname = f"{prefix}/{identifier}.bin"
+            if dedup:
+                key = _content_key(source)
+                if key in stored:
+                    first, member = stored[key]
+                    link = tarfile.TarInfo(arcname + suffix)
+                    link.type = tarfile.LNKTYPE
+                    link.linkname = member.name
+                    link.mode, link.mtime = member.mode, member.mtime
+                    tarball.addfile(link)
+                    members[str(identifier)] = members[first]
+                    checksums[str(identifier)] = checksums[first]
+                    continue
+
+            if isinstance(source, str) and not suffix:
+                # stream the file into the tarball, checksumming it on the way
+                info = tarball.gettarinfo(source, arcname=arcname)
+                with open(source, "rb") as f:
+                    reader = _Checksummed(f)
+                    tarball.addfile(info, reader)
+                checksums[str(identifier)] = (reader.length, reader.crc32)
+            else:
+                info = tarfile.TarInfo(arcname + suffix)
+                if isinstance(source, str):
+                    source_stat = os.stat(source)
+                    info.mode, info.mtime = source_stat.st_mode & 0o7777, source_stat.st_mtime
+                    with open(source, "rb") as f:
+                        source = f.read()
+                else:
+                    info.mode, info.mtime = 0o644, time.time()
+                checksums[str(identifier)] = (len(source), zlib.crc32(source))
+                data = compress(codec, source, compresslevel) if suffix else source
+                info.size = len(data)
+                tarball.addfile(info, io.BytesIO(data))
+
+            # the member data ends at the current offset, padded to whole blocks
+            member = tarball.members[-1]
+            padded_size = -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            members[str(identifier)] = (tarball.offset - padded_size, member.size)
+            if dedup:
+                stored[key] = (str(identifier), member)
+    return members, checksums
+
+
+def _content_key(source):
+    "what identifies the contents of a source for deduplication: the file it links to, or the hash of its bytes"
+    if isinstance(source, str):
+        info = os.stat(source)
+        return info.st_dev, info.st_ino
+    return hashlib.sha256(source).digest()
+
+
+def archive_files(path, codec):
+    "the archive at path and the index files written beside it"
+    files = [path, IndexedTar.sidecar_path(path)]
+    if codec == "gzip":
+        files.append(f"{path}.index.sqlite")
+    return files
+
+
+def read_sidecar(path, size=None):
+    "load the sidecar of the archive at path, or None if it is missing, unreadable or written for an archive of another size"
+    try:
+        with open(IndexedTar.sidecar_path(path), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != IndexedTar.version:
+        return None
+    size = os.path.getsize(path) if size is None else size
+    # a sidecar written for a different archive, such as before a recompress, is ignored
+    if data.get("size", size) != size:
+        return None
+    return data
+
+
+class MemberFile(io.RawIOBase):
+    "read-only file object over a byte range of an archive, using pread on a duplicated descriptor"
+
+    def __init__(self, fd, offset, size):
+        super().__init__()
+        self._fd = os.dup(fd)
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        self._pos = max(0, pos)
+        return self._pos
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._pos)
+        if length <= 0:
+            return 0
+        data = os.pread(self._fd, length, self._offset + self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def readall(self):
+        return self.read(self._size - self._pos)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        size = min(size, self._size - self._pos)
+        if size <= 0:
+            return b""
+        data = os.pread(self._fd, size, self._offset + self._pos)
+        self._pos += len(data)
+        return data
+
+
+class IndexedTar:
+    """
+    IndexedTar reads an uncompressed tarball through a sidecar offset table,
+    so opening a member costs one pread instead of a scan of the archive.
+    with a per-member codec, each member is decompressed after it is read.
+    """
+
+    version = 1
+
+    def __init__(self, path, codec="none"):
+        self.path = path
+        self.codec = codec
+        self._fd = None
+        self._mmap = None
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDONLY)
+        self.members = self._load_offsets()
+
+    @staticmethod
+    def sidecar_path(path):
+        return f"{path}.idx"
+
+    def _load_offsets(self):
+        "read the sidecar, falling back to a scan of the tar headers"
+        data = read_sidecar(self.path, size=os.fstat(self._fd).st_size)
+        if data is not None:
+            return {identifier: tuple(entry) for identifier, entry in data["members"].items()}
+        return self.scan()
+
+    def scan(self):
+        "map identifier to (offset, size) by reading the tar headers, skipping over member data"
+        with tarfile.open(self.path, mode="r:") as tarball:
+            return self.offsets(tarball)
+
+    def stored_sizes(self):
+        "map identifier to stored member size, read from the tar headers rather than the sidecar"
+        return {identifier: size for identifier, (_, size) in self.scan().items()}
+
+    @staticmethod
+    def offsets(tarball):
+        "map identifier to (offset, size) for the regular .bin members of an open tarfile, and hard links to them"
+        members = dict()
+        by_name = dict()
+        for member in tarball.getmembers():
+            identifier = member_identifier(member.name)
+            if identifier is None:
+                continue
+            if member.isfile():
+                members[identifier] = by_name[member.name] = (member.offset_data, member.size)
+            elif member.islnk() and member.linkname in by_name:
+                members[identifier] = by_name[member.linkname]
+        return members
+
+    @classmethod
+    def write_sidecar(cls, path, members, size=None, checksums=None):
+        "atomically write the offset table, and the crc32 of each member if given, for the tarball at path, which is size bytes long"
+        sidecar = cls.sidecar_path(path)
+        tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+        size = os.path.getsize(path) if size is None else size
+        data = {"version": cls.version, "size": size, "members": members}
+        if checksums is not None:
+            data["checksum"] = "crc32"
+            data["checksums"] = checksums
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, sidecar)
+
+    def open(self, identifier):
+        identifier = str(identifier)
+        if identifier not in self.members:
+            raise FileNotFoundError(f"{identifier}.bin not found inside {self.path}")
+        offset, size = self.members[identifier]
+        if self.codec in MEMBER_SUFFIXES:
+            return io.BytesIO(decompress(self.codec, os.pread(self._fd, size, offset)))
+        return MemberFile(self._fd, offset, size)
+
+    def buffer(self, identifier):
+        "return a read-only memoryview of a member, backed by a memory map of the whole tarball"
+        identifier = str(identifier)
+        if identifier not in self.members:
+            raise FileNotFoundError(f"{identifier}.bin not found inside {self.path}")
+        offset, size = self.members[identifier]
+        if self.codec in MEMBER_SUFFIXES:
+            # compressed members cannot be mapped, so return a view of a decompressed copy
+            return memoryview(decompress(self.codec, os.pread(self._fd, size, offset)))
+        with self._lock:
+            if self._mmap is None:
+                self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)[offset:offset + size]
+
+    def read_many(self, identifiers):
+        "yield (identifier, bytes) for the members that exist, in archive order"
+        found = sorted((self.members[identifier], identifier) for identifier in identifiers if identifier in self.members)
+        previous, data = None, None
+        for location, identifier in found:
+            if location != previous:
+                # deduplicated members share a location, and are read once
+                offset, size = previous = location
+                data = decompress(self.codec, os.pread(self._fd, size, offset))
+            yield identifier, data
+
+    def read_all(self):
+        "yield (identifier, bytes) for every member in one sequential pass"
+        yield from self.read_many(self.members)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views handed out by buffer() keep the map alive until they are released
+                pass
+            self._mmap = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+class RatarmountArchive:
+    """
+    RatarmountArchive reads a gzip-compressed tarball through ratarmount,
+    persisting the ratarmount index beside the archive so other processes can reuse it.
+    """
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # ratarmount prints timings when it loads a saved index; keep them off stdout
+        with _stdout_lock, redirect_stdout(sys.stderr):
+            self._rmc = rmc.open(path, recursive=True, writeIndex=True)
+
+    def open(self, identifier):
+        member = f"{self.prefix}/{identifier}.bin"
+        with self._lock:
+            info = self._file_info(member)
+            if info is None:
+                raise FileNotFoundError(f"{member} not found inside tarball")
+            return self._rmc.open(info)
+
+    def _file_info(self, member, info=None):
+        "ratarmount file info for a member, following a hard link to the member holding its data"
+        info = self._rmc.getFileInfo(member) if info is None else info
+        if info is not None and info.linkname and not stat.S_ISLNK(info.mode):
+            info = self._rmc.getFileInfo("/" + info.linkname.lstrip("/"))
+        return info
+
+    def stored_sizes(self):
+        "map identifier to member size, read from the ratarmount index without decompressing"
+        with self._lock:
+            listing = self._rmc.listDir(self.prefix) or dict()
+            sizes = dict()
+            for name in listing:
+                identifier = member_identifier(name)
+                if identifier is None:
+                    continue
+                info = self._file_info(f"{self.prefix}/{name}", listing[name] if isinstance(listing, dict) else None)
+                if info is not None:
+                    sizes[identifier] = info.size
+        return sizes
+
+    def buffer(self, identifier):
+        "compressed members cannot be mapped, so return a memoryview of a decompressed copy"
+        with self.open(identifier) as f:
+            return memoryview(f.read())
+
+    def read_many(self, identifiers):
+        "yield (identifier, bytes) for the members that exist, in archive order"
+        found = []
+        with self._lock:
+            for identifier in identifiers:
+                info = self._file_info(f"{self.prefix}/{identifier}.bin")
+                if info is not None:
+                    userdata = info.userdata[0] if info.userdata else None
+                    found.append((getattr(userdata, "offset", 0), identifier, info))
+        found.sort(key=lambda entry: entry[0])
+
+        for _, identifier, info in found:
+            with self._lock:
+                with self._rmc.open(info) as f:
+                    data = f.read()
+            yield identifier, data
+
+    def read_all(self):
+        "yield (identifier, bytes) for every member, decompressing the tarball once from start to end"
+        links = []
+        with tarfile.open(self.path, mode="r|*") as tarball:
+            for member in tarball:
+                identifier = member_identifier(member.name)
+                if identifier is None:
+                    continue
+                if member.isfile():
+                    yield identifier, tarball.extractfile(member).read()
+                elif member.islnk():
+                    # a stream cannot go back to the linked member, so read it through the index afterwards
+                    links.append(identifier)
+        for identifier in links:
+            with self.open(identifier) as f:
+                yield identifier, f.read()
+
+    def close(self):
+        # dropping the reference lets member files that are still open keep reading
+        self._rmc = None
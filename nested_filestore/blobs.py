@@ -0,0 +1,236 @@
+import os
+import errno
+import stat
+import hashlib
+import threading
+
+from .transfer import _NO_LINK, FSYNC_POLICIES, AtomicWriter, fsync_directory, publish, temp_path
+
+
+BLOB_DIRECTORY = ".blobs"
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """
+    BlobStore keeps one copy of each distinct payload under <root>/.blobs, named by its sha256,
+    and stores items as hard links to it, so identical items share their data.
+    payloads are hashed while they are copied in; a duplicate only costs the copy into a temporary file.
+    blobs are made read-only, since writing to one would change every item linked to it.
+    a blob whose only link is its own is unreferenced, such as after its items were compacted, and collect() removes it.
+    """
+
+    def __init__(self, root, fsync="none"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync}, expected one of {', '.join(FSYNC_POLICIES)}")
+        self.root = root
+        self.directory = os.path.join(root, BLOB_DIRECTORY)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._stats = {"items": 0, "duplicates": 0, "bytes_stored": 0, "bytes_saved": 0, "archive_bytes_saved": 0, "blobs_collected": 0}
+
+    def path(self, digest):
+        "the blob for a hex sha256 digest"
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, src, dst, move=False, overwrite=True):
+        "store the file src as dst, sharing the data of an identical blob; raises FileExistsError without overwrite if dst exists"
+        tmp_path = temp_path(os.path.join(self.directory, "incoming"))
+        os.makedirs(self.directory, exist_ok=True)
+        if move:
+            try:
+                # the source becomes the blob without copying; it is hashed in place
+                os.link(src, tmp_path)
+                with open(tmp_path, "rb") as f:
+                    digest, size = _hash(f)
+            except OSError as e:
+                # the source may be on another filesystem than the blob area
+                if e.errno not in _NO_LINK and e.errno != errno.EXDEV:
+                    raise
+                digest, size = self._copy_in(src, tmp_path)
+        else:
+            digest, size = self._copy_in(src, tmp_path)
+        self.adopt(tmp_path, dst, digest, size, overwrite=overwrite)
+        if move:
+            os.remove(src)
+
+    def _copy_in(self, src, tmp_path):
+        "copy src to tmp_path, hashing it on the way; returns (digest, size)"
+        hasher = hashlib.sha256()
+        size = 0
+        with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+            while chunk := fsrc.read(CHUNK_SIZE):
+                hasher.update(chunk)
+                fdst.write(chunk)
+                size += len(chunk)
+            if self.fsync != "none":
+                fdst.flush()
+                os.fsync(fdst.fileno())
+        return hasher.hexdigest(), size
+
+    def writer(self, dst, on_commit=None, overwrite=True, on_close=None):
+        "a writable file that is hashed as it is written and stored as dst when it is closed"
+        os.makedirs(self.directory, exist_ok=True)
+        return BlobWriter(self, dst, on_commit=on_commit, overwrite=overwrite, on_close=on_close)
+
+    def adopt(self, tmp_path, dst, digest, size, overwrite=True):
+        """
+        make the complete file at tmp_path, with the given sha256, the blob for its digest unless one exists,
+        then link the blob to dst. tmp_path is removed either way.
+        """
+        blob = self.path(digest)
+        try:
+            while True:
+                try:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    os.link(tmp_path, blob)
+                    duplicate = False
+                except FileExistsError:
+                    duplicate = True
+                except OSError as e:
+                    if e.errno not in _NO_LINK and e.errno != errno.EXDEV:
+                        raise
+                    # no hard links here: store a plain copy
+                    publish(tmp_path, dst, overwrite=overwrite)
+                    self._count(size, duplicate=False)
+                    return
+                try:
+                    self._link(blob, dst, overwrite)
+                except FileNotFoundError:
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        raise
+                    # collect() removed the existing blob in the meantime; store this copy instead
+                    continue
+                break
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+        self._count(size, duplicate=duplicate)
+
+    def _link(self, blob, dst, overwrite):
+        "hard link blob to dst, atomically replacing dst only with overwrite"
+        if overwrite:
+            link_path = temp_path(dst)
+            os.link(blob, link_path)
+            try:
+                os.replace(link_path, dst)
+            except BaseException:
+                os.remove(link_path)
+                raise
+        else:
+            try:
+                os.link(blob, dst)
+            except FileExistsError:
+                raise FileExistsError(errno.EEXIST, "already exists", dst)
+        if self.fsync == "dir":
+            fsync_directory(os.path.dirname(dst))
+
+    def _count(self, size, duplicate):
+        with self._lock:
+            self._stats["items"] += 1
+            if duplicate:
+                self._stats["duplicates"] += 1
+                self._stats["bytes_saved"] += size
+            else:
+                self._stats["bytes_stored"] += size
+
+    def count_archive(self, members, checksums):
+        "record the bytes a compacted group saved by storing members that share data once"
+        seen = set()
+        saved = 0
+        for identifier, (offset, _) in members.items():
+            if offset in seen:
+                saved += checksums[identifier][0]
+            seen.add(offset)
+        with self._lock:
+            self._stats["archive_bytes_saved"] += saved
+        return saved
+
+    def collect(self):
+        "remove blobs no item links to any more; returns the number of bytes freed"
+        freed = 0
+        removed = 0
+        try:
+            shards = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    info = entry.stat()
+                    if info.st_nlink == 1:
+                        os.remove(entry.path)
+                        freed += info.st_size
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        with self._lock:
+            self._stats["blobs_collected"] += removed
+        return freed
+
+    def usage(self):
+        "scan the blob area: distinct blobs, their bytes, the loose items linked to them and the bytes those links save"
+        usage = {"blobs": 0, "bytes": 0, "references": 0, "bytes_saved": 0}
+        try:
+            shards = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return usage
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith("."):
+                    continue
+                info = entry.stat()
+                references = info.st_nlink - 1
+                usage["blobs"] += 1
+                usage["bytes"] += info.st_size
+                usage["references"] += references
+                usage["bytes_saved"] += info.st_size * max(references - 1, 0)
+        return usage
+
+    @property
+    def stats(self):
+        "items stored by this process, how many were duplicates, and the bytes stored and saved"
+        with self._lock:
+            return dict(self._stats)
+
+
+class BlobWriter(AtomicWriter):
+    "AtomicWriter that hashes what is written and is stored through a BlobStore when it is closed"
+
+    def __init__(self, blobs, path, on_commit=None, overwrite=True, on_close=None):
+        self.blobs = blobs
+        self._hasher = hashlib.sha256()
+        self._size = 0
+        super().__init__(path, fsync=blobs.fsync, on_commit=on_commit, overwrite=overwrite, on_close=on_close)
+
+    def write(self, data):
+        self._hasher.update(data)
+        self._size += len(data)
+        return self._file.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _publish(self):
+        self.blobs.adopt(self.tmp_path, self.path, self._hasher.hexdigest(), self._size, overwrite=self.overwrite)
+
+
+def _hash(f):
+    "sha256 and size of the rest of a file"
+    hasher = hashlib.sha256()
+    size = 0
+    while chunk := f.read(CHUNK_SIZE):
+        hasher.update(chunk)
+        size += len(chunk)
+    return hasher.hexdigest(), size
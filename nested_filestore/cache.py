@@ -0,0 +1,204 @@
+import os
+import threading
+from collections import OrderedDict
+
+from .transfer import temp_path
+
+
+class ReadCache:
+    """
+    ReadCache keeps the contents of items read from compacted groups, so hot items are not decompressed again.
+    the memory tier holds up to max_bytes, evicting the least recently used items; with a directory,
+    evicted items spill to a disk tier of up to max_disk_bytes, which also survives restarts.
+    items larger than max_item_bytes are never cached.
+    each entry carries the tag it was cached with, naming the archive it was read from; a lookup with another tag misses,
+    so a disk tier shared by several stores, or kept while a group was rewritten by another process, never serves stale data.
+    entries otherwise only need invalidating when a group is rewritten or an item overwritten.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None, max_disk_bytes=1024 * 1024 * 1024, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes if directory is not None else 0
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max(max_bytes, self.max_disk_bytes) // 16
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        if directory is not None:
+            self._load_disk()
+
+    def get(self, identifier, tag=""):
+        "return the cached contents of an item, or None if it is not cached with this tag"
+        identifier = int(identifier)
+        with self._lock:
+            entry = self._memory.get(identifier)
+            if entry is not None and entry[0] == tag:
+                data = entry[1]
+                self._memory.move_to_end(identifier)
+                self.hits += 1
+                self.bytes_served += len(data)
+                return data
+            on_disk = self._disk.get(identifier, (None, 0))[0] == tag
+
+        if on_disk:
+            try:
+                with open(self._path(identifier, tag), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    if identifier in self._disk:
+                        self._disk.move_to_end(identifier)
+                    self.disk_hits += 1
+                    self.bytes_served += len(data)
+                # promote to memory; it stays on disk too
+                self.put(identifier, data, tag)
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, identifier, data, tag=""):
+        "cache the contents of an item under a tag, evicting least recently used items beyond the budget"
+        identifier = int(identifier)
+        data = bytes(data)
+        if len(data) > self.max_item_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(identifier, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous[1])
+            self._memory[identifier] = (tag, data)
+            self._memory_bytes += len(data)
+            evicted = []
+            while self._memory_bytes > self.max_bytes and self._memory:
+                evicted_identifier, (evicted_tag, evicted_data) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted_data)
+                self.evictions += 1
+                if self.directory is not None and self._disk.get(evicted_identifier, (None, 0))[0] != evicted_tag:
+                    evicted.append((evicted_identifier, evicted_tag, evicted_data))
+        for evicted_identifier, evicted_tag, evicted_data in evicted:
+            self._write_disk(evicted_identifier, evicted_tag, evicted_data)
+
+    def invalidate(self, identifier):
+        "forget one item, in both tiers"
+        identifier = int(identifier)
+        with self._lock:
+            entry = self._memory.pop(identifier, None)
+            if entry is not None:
+                self._memory_bytes -= len(entry[1])
+            on_disk = self._disk.pop(identifier, None)
+            if on_disk is not None:
+                self._disk_bytes -= on_disk[1]
+        if on_disk is not None:
+            self._remove_disk(identifier, on_disk[0])
+
+    def invalidate_range(self, start, stop):
+        "forget every item in [start, stop), such as the items of a group that was rewritten"
+        with self._lock:
+            for identifier in [identifier for identifier in self._memory if start <= identifier < stop]:
+                self._memory_bytes -= len(self._memory.pop(identifier)[1])
+            stale = [(identifier, self._disk[identifier]) for identifier in self._disk if start <= identifier < stop]
+            for identifier, (_, size) in stale:
+                del self._disk[identifier]
+                self._disk_bytes -= size
+        for identifier, (tag, _) in stale:
+            self._remove_disk(identifier, tag)
+
+    def clear(self):
+        self.invalidate_range(float("-inf"), float("inf"))
+
+    def _path(self, identifier, tag=""):
+        name = f"{identifier}.{tag}.bin" if tag else f"{identifier}.bin"
+        return os.path.join(self.directory, f"{identifier % 256:02x}", name)
+
+    def _remove_disk(self, identifier, tag):
+        try:
+            os.remove(self._path(identifier, tag))
+        except FileNotFoundError:
+            pass
+
+    def _write_disk(self, identifier, tag, data):
+        path = self._path(identifier, tag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = temp_path(path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            previous = self._disk.pop(identifier, None)
+            if previous is not None:
+                self._disk_bytes -= previous[1]
+            self._disk[identifier] = (tag, len(data))
+            self._disk_bytes += len(data)
+            evicted = []
+            if previous is not None and previous[0] != tag:
+                # the entry for an older archive of the item
+                evicted.append((identifier, previous[0]))
+            while self._disk_bytes > self.max_disk_bytes and self._disk:
+                evicted_identifier, (evicted_tag, size) = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.evictions += 1
+                evicted.append((evicted_identifier, evicted_tag))
+        for evicted_identifier, evicted_tag in evicted:
+            self._remove_disk(evicted_identifier, evicted_tag)
+
+    def _load_disk(self):
+        "register the items a previous process left in the disk tier, oldest first, keeping the newest entry of each item"
+        found = []
+        os.makedirs(self.directory, exist_ok=True)
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith("."):
+                    # a write that did not finish
+                    os.remove(entry.path)
+                elif entry.name.endswith(".bin"):
+                    identifier, _, tag = entry.name[:-len(".bin")].partition(".")
+                    entry_stat = entry.stat()
+                    found.append((entry_stat.st_mtime_ns, int(identifier), tag, entry_stat.st_size))
+        superseded = []
+        for _, identifier, tag, size in sorted(found):
+            previous = self._disk.pop(identifier, None)
+            if previous is not None:
+                self._disk_bytes -= previous[1]
+                superseded.append((identifier, previous[0]))
+            self._disk[identifier] = (tag, size)
+            self._disk_bytes += size
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            identifier, (tag, size) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            superseded.append((identifier, tag))
+        for identifier, tag in superseded:
+            self._remove_disk(identifier, tag)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+            "bytes_served": self.bytes_served,
+            "evictions": self.evictions,
+            "memory_bytes": self._memory_bytes,
+            "memory_items": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+            "disk_items": len(self._disk),
+        }
@@ -1,5 +1,5 @@
 class AlreadyExistsError(Exception):
     pass
 
-class GroupNotFullError(Exception):
+class GroupNotFullError(ValueError):
     pass
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+
+from .transfer import temp_path
+
+
+DATA_FILENAME = "data.bin"
+OFFSETS_FILENAME = "offsets.npy"
+MISSING_FILENAME = "missing.npy"
+META_FILENAME = "meta.json"
+
+# one row per identifier in the range; missing identifiers have length 0
+OFFSETS_DTYPE = [("identifier", "<i8"), ("offset", "<u8"), ("length", "<u8")]
+
+
+def _numpy():
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("exporting requires numpy; install nested-filestore[numpy]") from e
+    return np
+
+
+def export_range(index, start, stop, path, readahead=1):
+    """
+    write the items of [start, stop) to the directory path as one contiguous data file, data.bin,
+    and two arrays saved with numpy: offsets.npy, with the identifier, offset and length of every identifier in the range,
+    and missing.npy, a boolean mask of the identifiers that are not stored.
+    row n describes identifier start + n. each file is renamed into place once complete.
+    items are streamed with iter_range, so memory holds the arrays and up to readahead groups.
+    returns a summary dict of the export.
+    """
+    np = _numpy()
+    start, stop = int(start), int(stop)
+    if start > stop:
+        raise ValueError(f"start {start} is after stop {stop}")
+    os.makedirs(path, exist_ok=True)
+
+    began = time.perf_counter()
+    offsets = np.zeros(stop - start, dtype=OFFSETS_DTYPE)
+    offsets["identifier"] = np.arange(start, stop, dtype=np.int64)
+    missing = np.ones(stop - start, dtype=bool)
+
+    data_path = os.path.join(path, DATA_FILENAME)
+    tmp_paths = [temp_path(data_path)]
+    try:
+        position = 0
+        with open(tmp_paths[0], "wb") as f:
+            for identifier, data in index.iter_range(start, stop, readahead=readahead):
+                row = identifier - start
+                f.write(data)
+                offsets["offset"][row] = position
+                offsets["length"][row] = len(data)
+                missing[row] = False
+                position += len(data)
+
+        for filename, array in ((OFFSETS_FILENAME, offsets), (MISSING_FILENAME, missing)):
+            tmp_paths.append(temp_path(os.path.join(path, filename)))
+            with open(tmp_paths[-1], "wb") as f:
+                np.save(f, array)
+
+        summary = {
+            "start": start,
+            "stop": stop,
+            "items": int((~missing).sum()),
+            "missing": int(missing.sum()),
+            "bytes": position,
+            "seconds": time.perf_counter() - began,
+        }
+        tmp_paths.append(temp_path(os.path.join(path, META_FILENAME)))
+        with open(tmp_paths[-1], "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+        for tmp_path, filename in zip(tmp_paths, (DATA_FILENAME, OFFSETS_FILENAME, MISSING_FILENAME, META_FILENAME)):
+            os.replace(tmp_path, os.path.join(path, filename))
+    except BaseException:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    return summary
+
+
+class ExportedRange:
+    """
+    ExportedRange memory-maps a directory written by export_range, without touching the filestore.
+    indexing by identifier returns a read-only memoryview of its contents, or None if it was missing.
+    """
+
+    def __init__(self, path):
+        np = _numpy()
+        self.path = path
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILENAME), mmap_mode="r")
+        self.missing = np.load(os.path.join(path, MISSING_FILENAME), mmap_mode="r")
+        data_path = os.path.join(path, DATA_FILENAME)
+        # numpy cannot map an empty file
+        self.data = np.memmap(data_path, dtype=np.uint8, mode="r") if os.path.getsize(data_path) else np.zeros(0, dtype=np.uint8)
+        self.start = int(self.offsets["identifier"][0]) if len(self.offsets) else 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, identifier):
+        row = int(identifier) - self.start
+        if not 0 <= row < len(self.offsets):
+            raise KeyError(identifier)
+        if self.missing[row]:
+            return None
+        offset, length = int(self.offsets["offset"][row]), int(self.offsets["length"][row])
+        return memoryview(self.data[offset:offset + length])
@@ -1,95 +1,325 @@
 import os
-import tarfile
+import time
+import zlib
+import hashlib
+import logging
 import threading
+from collections import OrderedDict
 from functools import cached_property
 
-import ratarmountcore as rmc
-
 from .item import Item
+from .archive import CODECS, IndexedTar, RatarmountArchive, archive_files, open_archive, read_sidecar, write_archive
+from .segment import SEGMENT_EXTENSION, SEGMENT_INDEX_EXTENSION, Segment
+from .transfer import temp_path
 from .exceptions import GroupNotFullError
 
 
+logger = logging.getLogger(__name__)
+
+
+class CompactionReport:
+    "timing and throughput of compacting one group, or the error that stopped it"
+
+    def __init__(self, group, seconds, items, size, error=None):
+        self.group = group
+        self.seconds = seconds
+        self.items = items
+        self.size = size
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def items_per_second(self):
+        return self.items / self.seconds if self.seconds else float("inf")
+
+    @property
+    def bytes_per_second(self):
+        return self.size / self.seconds if self.seconds else float("inf")
+
+    def __repr__(self):
+        if self.error is not None:
+            return f"CompactionReport({self.group}, failed: {self.error!r})"
+        return f"CompactionReport({self.group}, {self.items} items, {self.size} bytes, {self.seconds:.3f}s)"
+
+
+class GroupCache(OrderedDict):
+    """
+    mapping of group uri to Group that a watcher thread can change while other threads read it.
+    changes are made under a lock, and iterating over it, its keys, values or items iterates over a snapshot.
+    with max_groups it is bounded, evicting the least recently used group; without, it holds every group in sorted order.
+    it also remembers up to max_groups groups found absent, with the mtime of their parent directory at the time,
+    since creating, compacting or removing a group changes that mtime.
+    """
+
+    def __init__(self, max_groups=None):
+        super().__init__()
+        self.max_groups = max_groups
+        self._lock = threading.RLock()
+        self._absent = OrderedDict()
+
+    def get(self, group_uri, default=None):
+        with self._lock:
+            if group_uri not in self:
+                return default
+            if self.max_groups is not None:
+                self.move_to_end(group_uri)
+            return super().__getitem__(group_uri)
+
+    def __setitem__(self, group_uri, group):
+        with self._lock:
+            self._absent.pop(group_uri, None)
+            super().__setitem__(group_uri, group)
+            if self.max_groups is not None:
+                self.move_to_end(group_uri)
+                while len(self) > self.max_groups:
+                    self.popitem(last=False)
+
+    def __delitem__(self, group_uri):
+        with self._lock:
+            super().__delitem__(group_uri)
+
+    def pop(self, group_uri, *default):
+        with self._lock:
+            return super().pop(group_uri, *default)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self._lock:
+            return list(OrderedDict.keys(self))
+
+    def values(self):
+        with self._lock:
+            return list(OrderedDict.values(self))
+
+    def items(self):
+        with self._lock:
+            return list(OrderedDict.items(self))
+
+    def sort(self):
+        "put the groups in uri order in one step; a bounded cache keeps its least recently used order"
+        if self.max_groups is not None:
+            return
+        with self._lock:
+            for group_uri in sorted(OrderedDict.keys(self)):
+                self.move_to_end(group_uri)
+
+    def is_absent(self, group_uri, parent_mtime_ns):
+        "whether group_uri was found absent while its parent directory had this mtime"
+        with self._lock:
+            return group_uri in self._absent and self._absent[group_uri] == parent_mtime_ns
+
+    def set_absent(self, group_uri, parent_mtime_ns):
+        "remember that group_uri is absent while its parent directory has this mtime"
+        with self._lock:
+            if group_uri in self:
+                return
+            self._absent[group_uri] = parent_mtime_ns
+            self._absent.move_to_end(group_uri)
+            while self.max_groups is not None and len(self._absent) > self.max_groups:
+                self._absent.popitem(last=False)
+
+
 class Group:
-    def __init__(self, index, identifier:str, is_tarball=None):
+    def __init__(self, index, identifier:str, is_tarball=None, codec=None):
         self.identifier = str(identifier)
         self.index = index
 
         # determine min and max from index dimensions and identifier
-        group_name = identifier.replace("/", "")
         self._bucket_size = self.index.base ** self.index.dimensions[0]
-        self._bucket_min = int(group_name) * self._bucket_size
+        self._bucket_min = self.index.parse_group(self.identifier) * self._bucket_size
         self._bucket_max = self._bucket_min + self._bucket_size - 1
 
         self._is_tarball = is_tarball
+        self._codec = codec
+        self._is_segment = None
+        self._cache_tag = None
+        self._lock = threading.Lock()
         self._tar_lock = threading.Lock()
-        self._tar_rmc = None
-        self._items = dict()
+
+        # membership bitmap: bit n is set when item _bucket_min + n exists
+        self._bitmap = bytearray((self._bucket_size + 7) // 8)
+        self._count = 0
+
+    def _offset(self, identifier):
+        offset = int(str(identifier)) - self._bucket_min
+        if offset < 0 or offset >= self._bucket_size:
+            raise ValueError(f"{identifier} does not belong in {self}")
+        return offset
 
     def add(self, identifier:str):
-        identifier = str(identifier)
-        self._items[identifier] = Item(self, identifier)
+        offset = self._offset(identifier)
+        mask = 1 << (offset & 7)
+        with self._lock:
+            if not self._bitmap[offset >> 3] & mask:
+                self._bitmap[offset >> 3] |= mask
+                self._count += 1
+
+    def discard(self, identifier:str):
+        offset = self._offset(identifier)
+        mask = 1 << (offset & 7)
+        with self._lock:
+            if self._bitmap[offset >> 3] & mask:
+                self._bitmap[offset >> 3] &= ~mask
+                self._count -= 1
 
     def get(self, identifier:str):
-        identifier = str(identifier)
+        if self.exists(identifier):
+            return Item(self, identifier)
+        raise ValueError(f"{identifier} not found in {self}")
+
+    @property
+    def bitmap(self):
+        "membership bitmap as bytes"
+        return bytes(self._bitmap)
+
+    @bitmap.setter
+    def bitmap(self, value):
+        if len(value) != len(self._bitmap):
+            raise ValueError(f"bitmap for {self} must be {len(self._bitmap)} bytes")
+        self._bitmap[:] = value
+        self._count = int.from_bytes(self._bitmap, "little").bit_count()
+
+    def reconcile(self, scanned, snapshot):
+        "set membership to a scanned bitmap, keeping items added since snapshot, the bitmap as it was before the scan"
+        scanned = int.from_bytes(scanned, "little")
+        snapshot = int.from_bytes(snapshot, "little")
+        with self._lock:
+            bits = scanned | (int.from_bytes(self._bitmap, "little") & ~snapshot)
+            self._bitmap[:] = bits.to_bytes(len(self._bitmap), "little")
+            self._count = bits.bit_count()
+
+    @property
+    def count(self):
+        "number of items in this group"
         if self.is_tarball:
-            if identifier not in self._items and int(identifier) <= int(self.max) and int(identifier) >= int(self.min):
-                self._items[identifier] = Item(self, identifier)
-            return self._items[identifier]
-        elif self.exists(identifier):
-            return self._items[identifier]
-        else:
-            raise ValueError(f"{identifier} not found in {self}")
+            return self._bucket_size
+        return self._count
 
     @property
-    def _ratarmount(self):
-        if self._tar_rmc is None:
-            self._tar_rmc = rmc.open(self._path_tgz, recursive=True)
-        return self._tar_rmc
+    def identifiers(self):
+        "iterate the identifiers in this group, in ascending order"
+        if self.is_tarball:
+            yield from range(self._bucket_min, self._bucket_max + 1)
+            return
+        bits = int.from_bytes(self._bitmap, "little")
+        while bits:
+            lowest = bits & -bits
+            yield self._bucket_min + lowest.bit_length() - 1
+            bits ^= lowest
+
+    def archive(self):
+        "context manager borrowing the reader for the compacted tarball from the index handle pool"
+        return self.index.handles.lease(self.uri, self._open_archive)
+
+    def _open_archive(self):
+        metrics = self.index.metrics
+        if not metrics.enabled:
+            return open_archive(self._path_archive, self.uri)
+        if self.codec == "gzip" and not os.path.exists(f"{self._path_archive}.index.sqlite"):
+            # ratarmount builds its index on this first open, reading the whole archive
+            metrics.count("archive.index_build")
+        with metrics.timer("archive.open"):
+            return open_archive(self._path_archive, self.uri)
+
+    def segment(self, create=False):
+        "context manager borrowing the segment of this group from the index handle pool, creating it if asked"
+        return self.index.handles.lease(
+            self.uri, lambda: Segment(self._path_segment, self.uri, fsync=self.index.fsync, create=create)
+        )
+
+    def append(self, identifier, data):
+        "append the contents of an item to the segment of this group, creating the segment if needed"
+        with self.segment(create=True) as segment:
+            segment.append(identifier, data)
+        self._is_segment = True
+
+    def redetect(self):
+        "forget whether this group is a tarball or a segment, so it is checked on the filesystem again"
+        self.close()
+        self._is_tarball = None
+        self._is_segment = None
+        self._codec = None
 
     def close(self):
         "ensure tarball is closed"
-        if self._tar_rmc is not None:
-            del self._tar_rmc
-            self._tar_rmc = None
+        self.index.handles.discard(self.uri)
+        self._cache_tag = None
 
     @property
     def is_full(self):
         if self.is_tarball:
             return False
         else:
-            if len(self._items) >= self._bucket_size:
-                # check that all files have size greater than zero
-                for item in self._items.values():
-                    filename = item.path
-                    if os.path.getsize(filename) == 0:
-                        return False
-                return True
+            # items are only added once their file is complete, so the bitmap is enough
+            return self._count >= self._bucket_size
 
     @property
     def missing(self):
         if self.is_tarball:
             return []
         else:
+            # invert the bitmap, ignoring padding bits past the end of the bucket
+            bits = ~int.from_bytes(self._bitmap, "little") & ((1 << self._bucket_size) - 1)
             missing = []
-            for identifier in range(self.min, self.max + 1):
-                if str(identifier) not in self._items:
-                    missing.append(identifier)
+            while bits:
+                lowest = bits & -bits
+                missing.append(self._bucket_min + lowest.bit_length() - 1)
+                bits ^= lowest
             return missing
 
+    @property
+    def codec(self):
+        "codec of the compacted tarball, or None if this group is a directory"
+        if self._codec is None and self._is_tarball is not False:
+            for codec, extension in CODECS.items():
+                if os.path.isfile(f"{self._path_dir}{extension}"):
+                    self._codec = codec
+                    break
+        return self._codec
+
+    def missing_ranges(self):
+        "return the identifiers missing from this group as sorted, half-open (start, stop) ranges"
+        if self.is_tarball:
+            return []
+        missing = ~int.from_bytes(self._bitmap, "little") & ((1 << self._bucket_size) - 1)
+        ranges = []
+        while missing:
+            start = (missing & -missing).bit_length() - 1
+            run = missing >> start
+            # the lowest clear bit of run marks the end of this run of missing items
+            length = (~run & (run + 1)).bit_length() - 1
+            ranges.append((self._bucket_min + start, self._bucket_min + start + length))
+            missing &= ~(((1 << length) - 1) << start)
+        return ranges
+
     @property
     def is_tarball(self):
         if self._is_tarball is None:
-            self._is_tarball = os.path.isfile(self._path_tgz)
+            self._is_tarball = self.codec is not None
         return self._is_tarball
 
+    @property
+    def is_segment(self):
+        "whether the items of this group are appended to a segment file rather than written as files"
+        if self._is_segment is None:
+            self._is_segment = not self.is_tarball and os.path.isfile(self._path_segment_index)
+        return self._is_segment
+
     @cached_property
     def uri(self):
         return self.identifier
 
     @property
     def path(self):
-        if self._is_tarball:
-            return self._path_tgz
+        if self.is_tarball:
+            return self._path_archive
+        elif self.is_segment:
+            return self._path_segment
         else:
             return self._path_dir
 
@@ -98,96 +328,324 @@ class Group:
         return f"{self.index.path}{self.uri}"
 
     @cached_property
-    def _path_tgz(self):
-        return f"{self.index.path}{self.uri}.tgz"
+    def _path_segment(self):
+        return f"{self._path_dir}{SEGMENT_EXTENSION}"
+
+    @cached_property
+    def _path_segment_index(self):
+        return f"{self._path_dir}{SEGMENT_INDEX_EXTENSION}"
+
+    @property
+    def _path_archive(self):
+        return f"{self._path_dir}{CODECS[self.codec]}"
+
+    @property
+    def cache_tag(self):
+        "names the compacted archive by path, size and mtime, so read cache entries of another archive are not used"
+        if self._cache_tag is None:
+            path = os.path.realpath(self._path_archive)
+            stat = os.stat(path)
+            identity = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+            self._cache_tag = hashlib.sha256(identity.encode()).hexdigest()[:16]
+        return self._cache_tag
 
     @property
     def min(self):
+        "lowest identifier in this group, or None if the group is empty"
         if self.is_tarball:
             return str(self._bucket_min)
-        return self.items[next(iter(sorted(self.items)))].identifier
+        bits = int.from_bytes(self._bitmap, "little")
+        if not bits:
+            return None
+        return str(self._bucket_min + (bits & -bits).bit_length() - 1)
 
     @property
     def max(self):
+        "highest identifier in this group, or None if the group is empty"
         if self.is_tarball:
             return str(self._bucket_max)
-        return self.items[next(reversed(sorted(self.items)))].identifier
+        bits = int.from_bytes(self._bitmap, "little")
+        if not bits:
+            return None
+        return str(self._bucket_min + bits.bit_length() - 1)
 
     @property
     def items(self):
-        if len(self._items) == 0 and self.is_tarball:
-            for identifier in range(self._bucket_min, self._bucket_max + 1):
-                if str(identifier) not in self._items:
-                    self._items[str(identifier)] = Item(self, str(identifier))
-        return self._items
+        "materialize a dict of Item objects for this group"
+        return {str(identifier): Item(self, identifier) for identifier in self.identifiers}
 
     def __repr__(self):
         return self.identifier
 
     def exists(self, identifier:str):
-        return str(identifier) in self.items
+        try:
+            offset = self._offset(identifier)
+        except ValueError:
+            return False
+        if self.is_tarball:
+            return True
+        return bool(self._bitmap[offset >> 3] & (1 << (offset & 7)))
 
-    def compact(self):
-        "create a tarball for this group"
-        if not self.is_full:
+    def read_many(self, identifiers):
+        "yield (identifier, bytes) for the given identifiers in storage order; missing items yield None"
+        identifiers = sorted({str(identifier) for identifier in identifiers}, key=int)
+        present = [identifier for identifier in identifiers if self.exists(identifier)]
+
+        if self.is_tarball:
+            found = set()
+            with self.archive() as archive:
+                for identifier, data in archive.read_many(present):
+                    found.add(identifier)
+                    yield identifier, data
+            present = found
+        elif self.is_segment:
+            found = set()
+            with self.segment() as segment:
+                for identifier, data in segment.read_many(present):
+                    found.add(identifier)
+                    yield identifier, data
+            present = found
+        else:
+            for identifier in present:
+                with Item(self, identifier).open() as f:
+                    yield identifier, f.read()
+
+        for identifier in identifiers:
+            if identifier not in present:
+                yield identifier, None
+
+    def read_all(self):
+        "yield (identifier, bytes) for every item in one sequential pass over the storage"
+        if self.is_tarball:
+            with self.archive() as archive:
+                yield from archive.read_all()
+        elif self.is_segment:
+            with self.segment() as segment:
+                yield from segment.read_all()
+        else:
+            for identifier in self.identifiers:
+                with Item(self, identifier).open() as f:
+                    yield str(identifier), f.read()
+
+    def compact(self, codec="gzip", compresslevel=None):
+        """
+        create a tarball for this group.
+        codec "gzip" writes a .tgz and persists its ratarmount index beside it;
+        codec "none" writes an uncompressed .tar with a sidecar offset table for O(1) member reads;
+        codecs "zstd" and "lz4" compress each member inside a .zst.tar or .lz4.tar with the same sidecar.
+        a segment group is sealed into its .tar in place for codec "none", and rewritten otherwise.
+        with dedup, items linked to the same blob are stored once and the others become tar hard links.
+        """
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec}, expected one of {', '.join(CODECS)}")
+        if self.is_tarball:
             return False
+        if not self.is_full:
+            raise GroupNotFullError(f"{self} is not full")
 
-        tarball_filename = self._path_tgz
-        container_path = self.uri
+        tarball_filename = f"{self._path_dir}{CODECS[codec]}"
         full_container_path = self._path_dir
 
-        with self._tar_lock:
+        with self._tar_lock, self.index.locks.exclusive(self.uri):
             if self._is_tarball is True:
                 return False
+            if self.index.locks.enabled:
+                # another process may have compacted it while this one waited for the lock
+                self.redetect()
+                if self.is_tarball or not (self.is_segment or os.path.isdir(full_container_path)):
+                    return False
+
+            # a complete archive of this group is never overwritten: it holds every item already
+            if any(os.path.exists(f"{self._path_dir}{extension}") for extension in CODECS.values()):
+                self.redetect()
+                return False
+
+            if self.is_segment:
+                self._compact_segment(tarball_filename, codec, compresslevel)
+                self._codec = codec
+                self._is_tarball = True
+                self._is_segment = False
+                return True
 
             # iterate files in the container path and add them to the tarball
-            filenames_to_remove = []
-            with tarfile.open(tarball_filename, mode="w:gz") as tarball:
-                for filename in sorted(os.listdir(full_container_path)):
-                    full_filename = os.path.join(full_container_path, filename)
-                    tarball.add(
-                        full_filename,
-                        arcname=os.path.join(container_path, filename),
-                        recursive=False
-                    )
-                    filenames_to_remove.append(full_filename)
-
-                # ensure the right number of files are now in the tarball
-                if len(tarball.getmembers()) != len(os.listdir(full_container_path)):
-                    raise ValueError(f"tarball {tarball_filename} contains different number of files than container path")
-
-            # iterate files again and delete them
-            for full_filename in filenames_to_remove:
+            # skip temporary files of writers that have not finished
+            filenames = sorted(
+                filename for filename in os.listdir(full_container_path)
+                if filename.endswith(".bin") and not filename.startswith(".")
+            )
+            sources = [
+                (filename[:-len(".bin")], os.path.join(full_container_path, filename))
+                for filename in filenames
+            ]
+            self._write_archive(tarball_filename, sources, codec, compresslevel)
+
+            # the archive is complete, so the group reads from it from now on
+            self._codec = codec
+            self._is_tarball = True
+
+            # iterate files again and delete them, with any temporary files left by writers that crashed
+            for _, full_filename in sources:
                 os.remove(full_filename)
-            os.rmdir(full_container_path)
+            for filename in os.listdir(full_container_path):
+                if filename.startswith(".") and filename.endswith(".tmp"):
+                    os.remove(os.path.join(full_container_path, filename))
+            try:
+                os.rmdir(full_container_path)
+            except OSError:
+                logger.warning("leaving %s in place: it holds files that are not items", full_container_path)
+
+        return True
 
+    def _write_archive(self, tarball_filename, sources, codec, compresslevel):
+        """
+        write the archive of this group from (identifier, source) pairs beside tarball_filename and rename it into place,
+        so readers and a crash never leave a partial archive at the final path.
+        """
+        tmp_path = temp_path(tarball_filename)
+        try:
+            members, checksums = write_archive(tmp_path, self.uri, sources, codec=codec, compresslevel=compresslevel, dedup=self.index.dedup)
+            # ensure the right number of files are now in the tarball
+            if len(members) != self._bucket_size:
+                raise ValueError(f"tarball {tarball_filename} has {len(members)} members, expected {self._bucket_size}")
+            # the sidecar names the size of the new archive, so it is ignored until the rename
+            IndexedTar.write_sidecar(tarball_filename, members, size=os.path.getsize(tmp_path), checksums=checksums)
+            os.replace(tmp_path, tarball_filename)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if codec == "gzip":
+            RatarmountArchive(tarball_filename, self.uri).close()
+        self._count_dedup(members, checksums)
+
+    def _compact_segment(self, tarball_filename, codec, compresslevel):
+        "seal the segment of a full group into its tarball, or write the tarball from the segment when sealing is not possible"
+        with self.segment() as segment:
+            segment.refresh()
+            if len(segment.members) != self._bucket_size:
+                raise ValueError(f"segment {self._path_segment} has {len(segment.members)} items, expected {self._bucket_size}")
+            # sealing keeps the member data where it is; other codecs, or a segment with superseded items, need a copy
+            if not (codec == "none" and segment.seal(tarball_filename)):
+                self._write_archive(tarball_filename, segment.read_all(), codec, compresslevel)
+                segment.remove()
+        self.close()
+
+    def _count_dedup(self, members, checksums):
+        if self.index.blobs is not None:
+            self.index.blobs.count_archive(members, checksums)
+
+    def recompress(self, codec="gzip", compresslevel=None):
+        """
+        rewrite the tarball of a compacted group with another codec or level.
+        the new archive is written beside the old one and renamed into place, so readers never see a partial archive.
+        """
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec}, expected one of {', '.join(CODECS)}")
+        if not self.is_tarball:
+            raise ValueError(f"{self} is not compacted")
+
+        with self._tar_lock, self.index.locks.exclusive(self.uri):
+            if self.index.locks.enabled:
+                # another process may have recompressed it while this one waited for the lock
+                self.redetect()
+            old_codec = self.codec
+            old_path = self._path_archive
+            new_path = f"{self._path_dir}{CODECS[codec]}"
+            tmp_path = temp_path(new_path)
+            try:
+                members, checksums = write_archive(tmp_path, self.uri, self.read_all(), codec=codec, compresslevel=compresslevel, dedup=self.index.dedup)
+                if len(members) != self._bucket_size:
+                    raise ValueError(f"recompressed {self} has {len(members)} members, expected {self._bucket_size}")
+                # the sidecar names the size of the new archive, so it is ignored until the rename
+                IndexedTar.write_sidecar(new_path, members, size=os.path.getsize(tmp_path), checksums=checksums)
+                os.replace(tmp_path, new_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            self.close()
+            if self.index.read_cache is not None:
+                self.index.read_cache.invalidate_range(self._bucket_min, self._bucket_max + 1)
+            for stale in archive_files(old_path, old_codec):
+                if stale not in (new_path, IndexedTar.sidecar_path(new_path)) and os.path.exists(stale):
+                    os.remove(stale)
+            if codec == "gzip":
+                RatarmountArchive(new_path, self.uri).close()
+
+            self._codec = codec
             self._is_tarball = True
 
         return True
 
+    def timed_compact(self, codec="gzip", compresslevel=None):
+        "compact this group, returning a CompactionReport, or None if it was already a tarball"
+        start = time.perf_counter()
+        if not self.compact(codec=codec, compresslevel=compresslevel):
+            return None
+        seconds = time.perf_counter() - start
+        self.index.metrics.observe("compact.group", int(seconds * 1e9))
+        return CompactionReport(self, seconds, self._bucket_size, os.path.getsize(self._path_archive))
+
+    def timed_recompress(self, codec="gzip", compresslevel=None):
+        "recompress this group, returning a CompactionReport"
+        start = time.perf_counter()
+        self.recompress(codec=codec, compresslevel=compresslevel)
+        seconds = time.perf_counter() - start
+        self.index.metrics.observe("recompress.group", int(seconds * 1e9))
+        return CompactionReport(self, seconds, self._bucket_size, os.path.getsize(self._path_archive))
+
     @property
     def is_valid(self):
         return self.validate() is True
 
-    def validate(self, raise_exception=False, debug=False):
+    def validate(self, raise_exception=False, debug=False, quick=False):
+        """
+        check a compacted group against the member table and checksums recorded when it was written.
+        quick only compares the member count and sizes in the archive headers or ratarmount index with the sidecar;
+        otherwise every member is read in one sequential pass and its length and crc32 are checked.
+        returns True, or the exception describing the first problem found.
+        """
         # if the group is not a tarball, then it is valid
         if not self.is_tarball:
             return True
-        
-        # if the group is a tarball, check the tarball exists
-        if not os.path.isfile(self._path_tgz):
-            raise FileNotFoundError(f"{self._path_tgz} not found")
-        
-        # try to get every identifier that should be in this group
-        for identifier in range(self._bucket_min, self._bucket_max + 1):
-            try:
-                fh = self.get(identifier).open()
-            except Exception as e:
-                if debug:
-                    breakpoint()
-                    break
-                elif raise_exception:
-                    raise e
-                return e
 
+        try:
+            self._validate(quick)
+        except Exception as e:
+            if debug:
+                breakpoint()
+            elif raise_exception:
+                raise e
+            return e
         return True
+
+    def _validate(self, quick):
+        # if the group is a tarball, check the tarball exists
+        if not os.path.isfile(self._path_archive):
+            raise FileNotFoundError(f"{self._path_archive} not found")
+
+        sidecar = read_sidecar(self._path_archive)
+        expected = {str(identifier) for identifier in range(self._bucket_min, self._bucket_max + 1)}
+
+        if quick:
+            with self.archive() as archive:
+                sizes = archive.stored_sizes()
+            if set(sizes) != expected:
+                raise ValueError(f"{self._path_archive} has {len(sizes)} members, expected {self._bucket_size}")
+            if sidecar is not None:
+                for identifier, (_, size) in sidecar["members"].items():
+                    if sizes.get(identifier) != size:
+                        raise ValueError(f"{identifier}.bin in {self._path_archive} is {sizes.get(identifier)} bytes, expected {size}")
+            return
+
+        checksums = sidecar.get("checksums", dict()) if sidecar is not None else dict()
+        seen = set()
+        for identifier, data in self.read_all():
+            seen.add(identifier)
+            if identifier in checksums:
+                length, crc32 = checksums[identifier]
+                if len(data) != length or zlib.crc32(data) != crc32:
+                    raise ValueError(f"{identifier}.bin in {self._path_archive} does not match its checksum")
+        if seen != expected:
+            raise ValueError(f"{self._path_archive} has {len(seen)} members, expected {self._bucket_size}")
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class _Entry:
+    __slots__ = ("handle", "leases", "evicted")
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.leases = 0
+        self.evicted = False
+
+
+class HandlePool:
+    """
+    HandlePool keeps a bounded number of tarball readers open, evicting the least recently used.
+    Handles are borrowed with lease(); an evicted handle is only closed once every lease on it has ended.
+    """
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, key, opener):
+        "borrow the handle for key, calling opener() to open it on a miss"
+        entry = self._acquire(key, opener)
+        try:
+            yield entry.handle
+        finally:
+            self._release(entry)
+
+    def _acquire(self, key, opener):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                entry.leases += 1
+                return entry
+            self.misses += 1
+
+        # open outside the lock, so a slow open does not block other groups
+        handle = opener()
+
+        to_close = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # another thread opened it first
+                to_close.append(handle)
+                self._entries.move_to_end(key)
+                entry.leases += 1
+            else:
+                entry = _Entry(handle)
+                entry.leases += 1
+                self._entries[key] = entry
+                to_close.extend(self._evict())
+
+        for handle in to_close:
+            handle.close()
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.leases -= 1
+            close = entry.evicted and entry.leases == 0
+        if close:
+            entry.handle.close()
+
+    def _evict(self):
+        "remove least recently used entries beyond max_open, returning the handles that can be closed now"
+        to_close = []
+        while len(self._entries) > self.max_open:
+            _, entry = self._entries.popitem(last=False)
+            self.evictions += 1
+            entry.evicted = True
+            if entry.leases == 0:
+                to_close.append(entry.handle)
+        return to_close
+
+    def discard(self, key):
+        "close the handle for key, once it is no longer leased"
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            entry.evicted = True
+            close = entry.leases == 0
+        if close:
+            entry.handle.close()
+
+    def clear(self):
+        for key in list(self._entries):
+            self.discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return {
+            "open": len(self._entries),
+            "max_open": self.max_open,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,36 +1,177 @@
 import os
 import re
-import glob
-import shutil
 import logging
+import time
+import queue
 import threading
 import datetime
 
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from .exceptions import GroupNotFullError
-from .group import Group
+from .group import CompactionReport, Group, GroupCache
 from .item import Item
+from .archive import CODECS, archive_codec
+from .manifest import Manifest
+from .handles import HandlePool
+from .locks import GroupLocks
+from .blobs import BlobStore
+from .export import export_range
+from .segment import SEGMENT, SEGMENT_INDEX_EXTENSION, SegmentWriter
+from .metrics import Metrics, timed
+from .watch import Watcher
+from .transfer import FSYNC_POLICIES, AtomicWriter, BulkPutResult, copy_file, move_file
+
+
+logger = logging.getLogger(__name__)
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# a directory modified this recently may be modified again without its mtime changing, within one timestamp tick
+RACY_MTIME_NS = 100_000_000
+
+
+def _read_ahead(items, load, depth):
+    "yield load(item) for each item, computing up to depth results ahead on a background thread"
+    if depth <= 0:
+        for item in items:
+            yield load(item)
+        return
+
+    results = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                result = load(item)
+                while not stopped.is_set():
+                    try:
+                        results.put((result, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    return
+            results.put((done, None))
+        except Exception as e:
+            results.put((None, e))
+
+    thread = threading.Thread(target=produce, name="nested-filestore-readahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+            yield result
+    finally:
+        # the consumer may stop early; let the producer exit
+        stopped.set()
+        while thread.is_alive():
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=0.1)
 
 
 class Index:
-    def __init__(self, path, dimensions, pad_character="0", base=10, sync=True):
+    def __init__(self, path, dimensions, pad_character="0", base=10, sync=True, manifest=True, fsync="none", max_open_tarballs=64, max_groups=4096, group_cache_size=65536, locking=False, metrics=False, read_cache=None, storage="files", dedup=False):
+        # sync=True loads every group at startup, using the manifest when there is one.
+        # sync="lazy" loads each group from the filesystem the first time it is touched, keeping at most
+        # max_groups of them; min, max, missing, compact and validate then only see the loaded groups.
+        # metrics=True, or a shared Metrics instance, records counters and timings of the hot paths in self.metrics.
+        # read_cache, a ReadCache, serves repeated reads of items in compacted groups without decompressing them again.
+        # locking=True coordinates writers and compaction in several processes through lock files under <root>/.locks.
+        # storage="segment" appends the items of new groups to one segment file per group instead of writing a file per item.
+        # dedup=True stores identical loose items once under <root>/.blobs, as hard links, and shares their data in compacted groups.
+        if storage not in ("files", "segment"):
+            raise ValueError(f"unknown storage {storage}, expected files or segment")
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync}, expected one of {', '.join(FSYNC_POLICIES)}")
         self.path = path
         self.dimensions = dimensions
-        self.base = 10
+        if not 2 <= base <= len(DIGITS):
+            raise ValueError(f"base must be between 2 and {len(DIGITS)}")
+        self.base = base
         self.pad_character = pad_character
-        self.groups = dict()
+        self._bucket_size = base ** dimensions[0]
+        self._level_sizes = [base ** level for level in dimensions[1:]]
+        # group uris are cached per group, not per identifier, and the cache is bounded
+        self._group_uri = lru_cache(maxsize=group_cache_size)(self._format_group_uri)
+        self.fsync = fsync
+        self.handles = HandlePool(max_open=max_open_tarballs)
+        self.locks = GroupLocks(path, enabled=locking)
+        self.metrics = metrics if isinstance(metrics, Metrics) else Metrics(enabled=bool(metrics))
+        self.watcher = None
+        self.read_cache = read_cache
+        self.storage = storage
+        self.dedup = dedup
+        self.blobs = BlobStore(path, fsync=fsync) if dedup else None
+        self.lazy = sync == "lazy"
+        if self.lazy:
+            # the manifest cannot be written from a partial view; its mtime checks stay valid without updates
+            self.groups = GroupCache(max_groups)
+            self.manifest = None
+        else:
+            self.groups = GroupCache()
+            self.manifest = Manifest(self) if manifest else None
         self._mkdir_lock = threading.Lock()
-        if sync:
-            self.sync()
+        if sync and not self.lazy:
+            self.refresh()
 
     def get_group(self, group_uri):
         "given a group uri, return the group object"
-        if group_uri in self.groups:
-            return self.groups[group_uri]
-        else:
+        group = self._find_group(group_uri)
+        if group is None:
             raise ValueError(f"{group_uri} not found in {self}")
+        return group
+
+    def _find_group(self, group_uri):
+        """
+        return the group for a uri, or None; in lazy mode, groups are loaded from the filesystem on first use.
+        the filesystem is read without holding the directory lock, and a group found absent costs one stat
+        of its parent directory until that directory changes.
+        """
+        group = self.groups.get(group_uri)
+        if group is not None or not self.lazy:
+            return group
+        parent = os.path.dirname(self.path + group_uri)
+        try:
+            parent_mtime_ns = os.stat(parent).st_mtime_ns
+        except FileNotFoundError:
+            parent_mtime_ns = None
+        if self.groups.is_absent(group_uri, parent_mtime_ns):
+            return None
 
+        loaded = self._load_group(group_uri)
+        if loaded is None:
+            if parent_mtime_ns is None or time.time_ns() - parent_mtime_ns > RACY_MTIME_NS:
+                self.groups.set_absent(group_uri, parent_mtime_ns)
+            return None
+        with self._mkdir_lock:
+            # another thread may have loaded or created it meanwhile
+            group = self.groups.get(group_uri)
+            if group is None:
+                group = self.groups[group_uri] = loaded
+        return group
+
+    def _load_group(self, group_uri):
+        "stat the tarball, read the segment or list the directory of a single group, without adding it to the index"
+        group = Group(self, group_uri)
+        if group.is_tarball:
+            return group
+        if group.is_segment:
+            return self._load_segment(group_uri, group)
+        if os.path.isdir(group._path_dir):
+            return self._scan_group(group_uri, group=group)
+        return None
+
+    @timed("get")
     def get(self, identifier:str):
         "given an identifier, return the item object"
         group_uri = self.which_group(identifier)
@@ -40,69 +181,314 @@ class Index:
         except ValueError:
             raise ValueError(f"{identifier} not found in {self}")
     
+    @timed("sync")
     def sync(self):
-        "sync the index with the filesystem"
-
-        # first locate .bin files
-        # create a group from the path, as necessary
-        # then create individual items
-        for binfile in glob.glob(f'{self.path}/**/*.bin', recursive=True):
-            binfile = binfile.replace(self.path, "")
-            binfile = binfile.replace(".bin", "")
-            identifier = os.path.basename(binfile)
-            subdir = os.path.dirname(binfile)
-            if subdir not in self.groups:
-                self.groups[subdir] = Group(self, subdir)
-            self.groups[subdir].add(identifier)
-
-        # # then locate .tgz files
-        for tarball in glob.glob(f'{self.path}/**/*.tgz', recursive=True):
-            tarball = tarball.replace(self.path, "")
-            tarball = tarball.replace(".tgz", "")
-            if tarball not in self.groups:
-                self.groups[tarball] = Group(self, tarball, is_tarball=True)
-
-        self.groups = dict(sorted(self.groups.items()))
+        "sync the index with the filesystem, listing every group"
+
+        # walk the directory levels above the groups
+        # create a group for each group directory or tarball, as necessary
+        # then list individual items, and drop groups that are gone
+        seen = set()
+        for group_uri, codec, mtime_ns in self._walk():
+            seen.add(group_uri)
+            if codec == SEGMENT:
+                self._load_segment(group_uri)
+            elif codec is not None:
+                self._tarball_group(group_uri, codec)
+            else:
+                self._scan_group(group_uri, mtime_ns)
+        self._forget_groups(seen)
+
+        self.groups.sort()
+
+    @timed("refresh")
+    def refresh(self):
+        "load the index from the manifest, listing only the groups that changed since it was saved"
+        snapshot = self.manifest.load() if self.manifest is not None else None
+        if snapshot is None:
+            return self.sync()
+
+        seen = set()
+        for group_uri, codec, mtime_ns in self._walk():
+            seen.add(group_uri)
+            if codec == SEGMENT:
+                self._load_segment(group_uri)
+            elif codec is not None:
+                self._tarball_group(group_uri, codec)
+            elif self.manifest.is_current(group_uri, mtime_ns) and group_uri in snapshot:
+                group = self.groups.get(group_uri)
+                if group is None:
+                    group = self.groups[group_uri] = Group(self, group_uri)
+                group.bitmap = snapshot[group_uri]
+            else:
+                self._scan_group(group_uri, mtime_ns)
+
+        for group_uri in list(self.manifest.entries):
+            if group_uri not in seen:
+                self.manifest.forget(group_uri)
+        self._forget_groups(seen)
+
+        self.groups.sort()
+
+        if self.manifest.dirty:
+            try:
+                self.manifest.save()
+            except OSError as e:
+                logger.warning("could not update manifest %s: %s", self.manifest.path, e)
+
+    def save(self):
+        "write the manifest so the next startup can skip unchanged groups"
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def close(self):
+        "stop watching, close any open tarballs and write the manifest if it changed"
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.handles.clear()
+        if self.manifest is not None and self.manifest.dirty:
+            self.manifest.save()
+
+    def _walk(self):
+        "yield (group_uri, codec, mtime_ns) for every group directory, tarball and segment under the root; codec is SEGMENT for segments"
+        depth = len(self.dimensions) - 1
+
+        def walk(path, uri, level):
+            try:
+                entries = list(os.scandir(path))
+            except FileNotFoundError:
+                return
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.name.startswith("."):
+                    continue
+                if level < depth - 1:
+                    if entry.is_dir() and self._is_component(entry.name, entry.path):
+                        yield from walk(entry.path, f"{uri}/{entry.name}", level + 1)
+                elif entry.is_dir():
+                    if self._is_component(entry.name, entry.path):
+                        yield f"{uri}/{entry.name}", None, entry.stat().st_mtime_ns
+                elif entry.name.endswith(SEGMENT_INDEX_EXTENSION):
+                    name = entry.name[:-len(SEGMENT_INDEX_EXTENSION)]
+                    if self._is_component(name, entry.path):
+                        yield f"{uri}/{name}", SEGMENT, entry.stat().st_mtime_ns
+                elif (codec := archive_codec(entry.name)) is not None:
+                    name = entry.name[:-len(CODECS[codec])]
+                    if self._is_component(name, entry.path):
+                        yield f"{uri}/{name}", codec, None
+
+        yield from walk(self.path, "", 0)
+
+    def _is_component(self, name, path):
+        "whether name can be a component of a group uri, logging what is skipped, such as lost+found"
+        digits = name.lstrip(self.pad_character)
+        if all(digit in DIGITS[:self.base] for digit in digits):
+            return True
+        logger.warning("ignoring %s: it is not a group", path)
+        return False
+
+    def _scan_group(self, group_uri, mtime_ns=None, group=None):
+        "list the .bin files of a group directory, replacing what was known about it; a group not yet in the index may be given"
+        if group is None:
+            group = self.groups.get(group_uri)
+            if group is None:
+                group = self.groups[group_uri] = Group(self, group_uri)
+        if group._is_tarball:
+            # the directory may be left over from a compaction in progress, or the tarball may be gone
+            group.redetect()
+            if group.is_tarball:
+                return group
+
+        snapshot = group.bitmap
+        scanned = bytearray(len(snapshot))
+        for entry in os.scandir(group._path_dir):
+            if entry.name.endswith(".bin") and not entry.name.startswith("."):
+                try:
+                    offset = group._offset(entry.name[:-len(".bin")])
+                except ValueError:
+                    logger.warning("ignoring %s: it does not belong in group %s", entry.path, group_uri)
+                    continue
+                scanned[offset >> 3] |= 1 << (offset & 7)
+        group.reconcile(scanned, snapshot)
+        if self.manifest is not None:
+            self.manifest.record(group_uri, mtime_ns)
+        return group
+
+    def _tarball_group(self, group_uri, codec):
+        "make sure the group for a tarball found on the filesystem is known as a tarball"
+        group = self.groups.get(group_uri)
+        if group is None:
+            self.groups[group_uri] = Group(self, group_uri, is_tarball=True, codec=codec)
+        elif not group._is_tarball or group._codec != codec:
+            # compacted or recompressed since it was loaded
+            group.redetect()
+        if self.manifest is not None:
+            self.manifest.record(group_uri, tarball=True)
+
+    def _load_segment(self, group_uri, group=None):
+        "read the index log of a segment found on the filesystem, adding the items appended since it was last read; a group not yet in the index may be given"
+        if group is None:
+            group = self.groups.get(group_uri)
+        if group is None:
+            group = self.groups[group_uri] = Group(self, group_uri)
+        elif not group._is_segment:
+            # loaded before its first append, or as a directory or tarball
+            group.redetect()
+        if not group.is_segment:
+            return group
+        try:
+            with group.segment() as segment:
+                segment.refresh()
+                identifiers = list(segment.members)
+        except FileNotFoundError:
+            # sealed or removed since it was listed
+            group.redetect()
+            return group
+        # segments only grow until they are sealed, so no item is ever dropped here
+        for identifier in identifiers:
+            try:
+                group.add(identifier)
+            except ValueError:
+                logger.warning("ignoring %s: it does not belong in group %s", identifier, group_uri)
+        return group
+
+    def _forget_groups(self, seen):
+        "drop groups that are no longer on the filesystem"
+        for group_uri in self.groups:
+            if group_uri not in seen:
+                self._forget_group(group_uri)
+
+    def _forget_group(self, group_uri):
+        group = self.groups.pop(group_uri, None)
+        if group is not None:
+            group.close()
+        if self.manifest is not None:
+            self.manifest.forget(group_uri)
+
+    def reload_group(self, group_uri):
+        "look at one group on the filesystem again after it changed: rescan its directory or segment, switch it to a tarball, or drop it"
+        group = self.groups.get(group_uri)
+        if group is None and self.lazy:
+            # unloaded groups are read from the filesystem when they are first used
+            return None
+        if group is not None and group._is_segment and os.path.isfile(group._path_segment_index):
+            # appended to: keep the open segment and read only the new records
+            return self._load_segment(group_uri)
+        if group is not None:
+            if self.read_cache is not None and group._is_tarball:
+                # the archive may have been rewritten or unpacked
+                self.read_cache.invalidate_range(group._bucket_min, group._bucket_max + 1)
+            group.redetect()
+        probe = group or Group(self, group_uri)
+        if probe.is_tarball:
+            self._tarball_group(group_uri, probe.codec)
+            return self.groups.get(group_uri)
+        if probe.is_segment:
+            if group is None:
+                self.groups[group_uri] = probe
+            return self._load_segment(group_uri)
+        if os.path.isdir(probe._path_dir):
+            return self._scan_group(group_uri)
+        self._forget_group(group_uri)
+        return None
+
+    def update_item(self, group_uri, identifier, present):
+        "record that an item appeared in or disappeared from a group directory"
+        group = self.groups.get(group_uri)
+        if group is None:
+            if present:
+                self.reload_group(group_uri)
+            return
+        if group.is_tarball:
+            return
+        try:
+            if present:
+                group.add(identifier)
+            else:
+                group.discard(identifier)
+        except ValueError:
+            logger.warning("ignoring %s: it does not belong in group %s", identifier, group_uri)
+            return
+        if self.manifest is not None:
+            self.manifest.touch(group_uri)
+
+    def watch(self, backend="auto", interval=1.0):
+        """
+        keep this index current with changes other processes make under its root, on a background thread.
+        backend is "inotify", "poll" or "auto", which uses inotify where it is available. returns the started Watcher.
+        """
+        if self.watcher is None:
+            self.watcher = Watcher(self, backend=backend, interval=interval)
+            self.watcher.start()
+        return self.watcher
 
     def __repr__(self):
         return f"Index({self.path})"
     
     @property
     def min(self):
-        min_group = self.groups[next(iter(sorted(self.groups)))]
-        return min_group.min
+        groups = [group for group in self.groups.values() if group.count]
+        return min(groups, key=lambda group: group._bucket_min).min
 
     @property
     def max(self):
-        max_group = self.groups[next(reversed(sorted(self.groups)))]
-        return max_group.max
+        groups = [group for group in self.groups.values() if group.count]
+        return max(groups, key=lambda group: group._bucket_min).max
 
-    @lru_cache(maxsize=None)
     def which_group(self, identifier):
-        "based on the hierarchy order, return a tuple of the path components for the given identifier"
-        identifier_str = str(identifier)
+        "based on the hierarchy order, return the uri of the group for the given identifier"
+        if self.metrics.enabled:
+            self.metrics.count("which_group")
+        return self._group_uri(int(identifier) // self._bucket_size)
 
-        # get the leaf id, which is the last N digits of the identifier
-        leaf_order = self.dimensions[0]
+    def group_id(self, identifier):
+        "return the number of the group for the given identifier"
+        return int(identifier) // self._bucket_size
 
-        # remove the right-most leaf_order digits from the string
-        identifier_str = identifier_str[:-leaf_order]
+    def group_ids(self, identifiers):
+        "vectorized group_id: map an array of identifiers to an array of group numbers, for batch planning"
+        try:
+            import numpy as np
+        except ImportError as e:
+            raise ImportError("group_ids requires numpy; install nested-filestore[numpy]") from e
+        return np.asarray(identifiers, dtype=np.int64) // self._bucket_size
 
-        subdirs = []
-        for level in self.dimensions[1:]:
-            # get the subdir id, which is the last N digits of the identifier
-            subdir_id = identifier_str[-level:]
+    def group_uri(self, group_id):
+        "return the uri of the group with the given number"
+        return self._group_uri(int(group_id))
 
-            # pad the subdir id with the pad character if it is too short
-            if len(subdir_id) < level:
-                subdir_id = subdir_id.rjust(level, self.pad_character)
-            subdirs.insert(0, subdir_id)
+    def _format_group_uri(self, group_id):
+        # each level below the top is a fixed-width number in the index base;
+        # the top level keeps whatever is left, so large identifiers do not wrap around
+        subdirs = []
+        for n, level in enumerate(self.dimensions[1:]):
+            if n < len(self.dimensions) - 2:
+                group_id, digits = divmod(group_id, self._level_sizes[n])
+            else:
+                digits = group_id
+            subdirs.insert(0, self._format_digits(digits).rjust(level, self.pad_character))
+        return "/" + "/".join(subdirs)
 
-            # remove right-most level digits from the string
-            identifier_str = identifier_str[:-level]
+    def _format_digits(self, number):
+        if self.base == 10:
+            return str(number)
+        digits = ""
+        while True:
+            number, digit = divmod(number, self.base)
+            digits = DIGITS[digit] + digits
+            if number == 0:
+                return digits
 
-        return "/" + os.path.join(*subdirs)
+    def parse_group(self, group_uri):
+        "inverse of group_uri: return the group number for a group uri"
+        group_id = 0
+        components = group_uri.strip("/").split("/")
+        for component, level in zip(components, reversed(self.dimensions[1:])):
+            digits = component.lstrip(self.pad_character) or "0"
+            group_id = group_id * self.base ** level + int(digits, self.base)
+        return group_id
 
+    @timed("exists")
     def exists(self, identifier):
         # determine which group should contain the item with the given identifier
         identifier = str(identifier)
@@ -113,12 +499,147 @@ class Index:
         except ValueError:
             return False
 
+    def exists_many(self, identifiers):
+        "yield (identifier, exists) for each identifier, looking up each group once"
+        groups = dict()
+        for identifier in identifiers:
+            group_uri = self.which_group(str(identifier))
+            if group_uri not in groups:
+                groups[group_uri] = self._find_group(group_uri)
+            group = groups[group_uri]
+            yield identifier, group is not None and group.exists(identifier)
+
+    def get_many(self, identifiers, ordered=True):
+        """
+        yield (identifier, bytes) for many identifiers, opening each group once and reading it in storage order.
+        with ordered=True, results follow the request order; otherwise they are yielded as each group is read.
+        identifiers that do not exist yield None.
+        """
+        requested = list(identifiers)
+
+        # plan: group uri -> identifier -> positions in the request
+        plan = dict()
+        for position, identifier in enumerate(requested):
+            identifier = str(identifier)
+            group_plan = plan.setdefault(self.which_group(identifier), dict())
+            group_plan.setdefault(identifier, []).append(position)
+
+        # in request order, visit groups as first requested to keep few results pending
+        group_uris = list(plan) if ordered else sorted(plan)
+
+        pending = dict()
+        next_position = 0
+        for group_uri in group_uris:
+            group_plan = plan[group_uri]
+            group = self._find_group(group_uri)
+            if group is None:
+                results = ((identifier, None) for identifier in group_plan)
+            else:
+                results = group.read_many(group_plan)
+
+            for identifier, data in results:
+                for position in group_plan[identifier]:
+                    if ordered:
+                        pending[position] = data
+                    else:
+                        yield requested[position], data
+
+                while next_position in pending:
+                    yield requested[next_position], pending.pop(next_position)
+                    next_position += 1
+
+    def iter_range(self, start, stop, include_missing=False, readahead=1):
+        """
+        yield (identifier, bytes) for stored identifiers in [start, stop), in identifier order.
+        each group is read in one sequential pass; tarballs are streamed from start to end.
+        with include_missing=True, absent identifiers yield (identifier, None).
+        up to readahead groups are read ahead on a background thread, bounding memory to that many groups.
+        """
+        start, stop = int(start), int(stop)
+        if start >= stop:
+            return
+
+        def load(group):
+            low = max(start, group._bucket_min)
+            high = min(stop, group._bucket_max + 1)
+            if low == group._bucket_min and high == group._bucket_max + 1:
+                results = group.read_all()
+            else:
+                results = group.read_many(i for i in group.identifiers if low <= i < high)
+            return sorted((int(identifier), data) for identifier, data in results if data is not None)
+
+        position = start
+        for members in _read_ahead(self._groups_in_range(start, stop), load, readahead):
+            for identifier, data in members:
+                if include_missing:
+                    while position < identifier:
+                        yield position, None
+                        position += 1
+                yield identifier, data
+                position = identifier + 1
+
+        if include_missing:
+            while position < stop:
+                yield position, None
+                position += 1
+
+    def export_range(self, start, stop, path, readahead=1):
+        "write the items of [start, stop) to the directory path as one data file plus numpy offsets and missing arrays; returns a summary"
+        return export_range(self, start, stop, path, readahead=readahead)
+
+    def _groups_in_range(self, start, stop):
+        "groups overlapping [start, stop), in identifier order"
+        if self.lazy:
+            group_ids = range(self.group_id(start), self.group_id(stop - 1) + 1)
+            groups = (self._find_group(self.group_uri(group_id)) for group_id in group_ids)
+            return (group for group in groups if group is not None)
+        return sorted(
+            (group for group in self.groups.values() if group._bucket_max >= start and group._bucket_min < stop),
+            key=lambda group: group._bucket_min
+        )
+
     @property
     def missing(self):
-        for idx in range(int(self.min), int(self.max) + 1):
-            if not self.exists(idx):
-                yield idx
+        for start, stop in self.missing_ranges():
+            yield from range(start, stop)
+
+    def missing_ranges(self, start=None, stop=None):
+        """
+        yield the identifiers missing from [start, stop) as merged, half-open (start, stop) ranges.
+        the span defaults to min..max. compacted groups are skipped, absent groups become one range,
+        and partial groups are read from their bitmap.
+        """
+        start = int(self.min) if start is None else int(start)
+        stop = int(self.max) + 1 if stop is None else int(stop)
+        if start >= stop:
+            return
 
+        def pieces():
+            position = start
+            for group in self._groups_in_range(start, stop):
+                low = max(start, group._bucket_min)
+                high = min(stop, group._bucket_max + 1)
+                # everything between the previous group and this one is absent
+                yield position, low
+                for missing_start, missing_stop in group.missing_ranges():
+                    yield max(low, missing_start), min(high, missing_stop)
+                position = high
+            yield position, stop
+
+        current = None
+        for piece_start, piece_stop in pieces():
+            if piece_start >= piece_stop:
+                continue
+            if current is not None and current[1] == piece_start:
+                current = (current[0], piece_stop)
+                continue
+            if current is not None:
+                yield current
+            current = (piece_start, piece_stop)
+        if current is not None:
+            yield current
+
+    @timed("put")
     def put(self, identifier, filename=None, filehandle=False, move=False, overwrite=False):
         "given the path to an existing file, and given an identifier, copy the file to the file store and put it in the right place, creating directories as needed."
 
@@ -128,52 +649,330 @@ class Index:
         dst_group_uri = self.which_group(identifier)
 
         # if group does not already exist, create it
-        if dst_group_uri not in self.groups:
+        dst_group = self._find_group(dst_group_uri)
+        if dst_group is None:
             with self._mkdir_lock:
-                self.groups[dst_group_uri] = Group(self, dst_group_uri)
-                dst_group = self.groups[dst_group_uri]
+                # another thread may have created it meanwhile
+                dst_group = self.groups.get(dst_group_uri)
+                if dst_group is None:
+                    dst_group = Group(self, dst_group_uri)
+                    self.groups[dst_group_uri] = dst_group
 
                 if dst_group.is_tarball:
                     # if group is inside a tarball, raise an error for now
                     raise ValueError(f"{identifier} is inside a tarball. Cannot put.")
                 else:
                     # ensure the path exists if not tarball
-                    os.makedirs(dst_group._path_dir, exist_ok=True)
-        else:
-            dst_group = self.groups[dst_group_uri]
+                    self._prepare_group(dst_group)
 
         new_item = Item(dst_group, identifier)
-        dst_group.add(new_item)
 
-        if filehandle:
-            return open(new_item.path, "wb")
-        elif filename:
+        # write to a temporary file and rename it into place, then make the item visible
+        def commit():
+            if overwrite and self.read_cache is not None:
+                self.read_cache.invalidate(identifier)
+            dst_group.add(new_item)
+            if self.manifest is not None:
+                self.manifest.touch(dst_group_uri)
+
+        if not filehandle and not filename:
+            raise ValueError("either filename or filehandle must be specified.")
+
+        if self._appends(dst_group):
+            # a segment writer buffers the item in memory, so the group is only locked while it is appended
+            if filehandle:
+                return SegmentWriter(dst_group, identifier, on_commit=commit, append=lambda data: self._append(dst_group, identifier, data, overwrite))
+            with open(filename, "rb") as f:
+                self._append(dst_group, identifier, f.read(), overwrite)
             if move:
-                shutil.move(filename, new_item.path)
-            else:
-                shutil.copy(filename, new_item.path)
+                os.remove(filename)
+            commit()
             return new_item
+
+        # hold the group lock in shared mode until the item is in place, so compaction cannot remove the directory.
+        release = self.locks.acquire(dst_group_uri)
+        try:
+            self._recheck_group(dst_group, identifier)
+            if filehandle:
+                if self.blobs is not None:
+                    return self.blobs.writer(new_item.path, on_commit=commit, overwrite=overwrite, on_close=release)
+                return AtomicWriter(new_item.path, fsync=self.fsync, on_commit=commit, overwrite=overwrite, on_close=release)
+            else:
+                try:
+                    self._transfer(filename, new_item.path, move, overwrite)
+                except FileExistsError:
+                    raise ValueError(f"{identifier} already exists.")
+                commit()
+        except BaseException:
+            release()
+            raise
+        release()
+        return new_item
+
+    def _append(self, group, identifier, data, overwrite):
+        """
+        append an item to the segment of a group under the group lock.
+        appends cannot refuse to replace an item, so without overwrite the lock is exclusive while the segment is checked.
+        """
+        release = self.locks.acquire(group.uri, exclusive=not overwrite)
+        try:
+            self._recheck_group(group, identifier)
+            if not overwrite and self.locks.enabled:
+                self._check_segment(group, identifier)
+            group.append(identifier, data)
+        finally:
+            release()
+
+    def _transfer(self, filename, path, move, overwrite):
+        "copy or move a file to the path of a loose item, through the blob store with dedup"
+        if self.blobs is not None:
+            self.blobs.put(filename, path, move=move, overwrite=overwrite)
+        elif move:
+            move_file(filename, path, fsync=self.fsync, overwrite=overwrite)
         else:
-            raise ValueError("either filename or filehandle must be specified.")
+            copy_file(filename, path, fsync=self.fsync, overwrite=overwrite)
 
-    def compact(self):
-        "given an identifier, try to compact the group its group, ignoring GroupNotFullError"
-        for group_uri in self.groups:
-            group = self.get_group(group_uri)
-            group.compact()
+    def _recheck_group(self, group, identifier):
+        "with cross-process locking, another process may have compacted the group, so look at the filesystem again"
+        if not self.locks.enabled:
+            return
+        group.redetect()
+        if group.is_tarball:
+            raise ValueError(f"{identifier} is inside a tarball. Cannot put.")
+        self._prepare_group(group)
+
+    def _appends(self, group):
+        "whether new items of a group go into its segment: existing groups keep their layout, and new ones follow storage"
+        if group.is_segment:
+            return True
+        return self.storage == "segment" and not os.path.isdir(group._path_dir)
+
+    def _prepare_group(self, group):
+        "create the directory a new item of a group is written into, or the parent directory of its segment"
+        if self._appends(group):
+            os.makedirs(os.path.dirname(group._path_dir), exist_ok=True)
+        else:
+            os.makedirs(group._path_dir, exist_ok=True)
+
+    def _check_segment(self, group, identifier):
+        "raise if another process appended identifier to the segment of a group"
+        if not group.is_segment:
+            return
+        with group.segment() as segment:
+            segment.refresh()
+            if str(int(identifier)) in segment.members:
+                group.add(identifier)
+                raise ValueError(f"{identifier} already exists.")
+
+    def _open_group(self, group_uri):
+        "find or create the group a batch of new items goes into, with its directory; returns (group, appends)"
+        # resolve the group first: in lazy mode, _find_group takes the directory lock itself
+        group = self._find_group(group_uri)
+        with self._mkdir_lock:
+            if group is None:
+                group = self.groups.get(group_uri)
+            if group is None:
+                group = Group(self, group_uri)
+                self.groups[group_uri] = group
+            elif self.locks.enabled:
+                # another process may have compacted it
+                group.redetect()
+            if not group.is_tarball:
+                self._prepare_group(group)
+            return group, self._appends(group)
+
+    @timed("put_many")
+    def put_many(self, sources, move=False, overwrite=False, workers=8):
+        """
+        given (identifier, filename) pairs, copy or move many files into the file store.
+        destination groups are planned and their directories created once, then files are transferred on a thread pool,
+        group by group, holding each group lock only while its transfers are in flight.
+        returns a BulkPutResult listing successes, conflicts and failures instead of raising.
+        """
+        result = BulkPutResult()
+
+        # plan destinations by group, rejecting conflicts up front
+        planned = dict()
+        seen = set()
+        for identifier, filename in sources:
+            identifier = str(identifier)
+            if identifier in seen or (not overwrite and self.exists(identifier)):
+                result.conflicts.append(identifier)
+                continue
+            seen.add(identifier)
+            planned.setdefault(self.which_group(identifier), []).append((identifier, filename))
+
+        def put_one(identifier, group, appends, filename):
+            if group.is_tarball:
+                raise ValueError(f"{identifier} is inside a tarball. Cannot put.")
+            if not appends:
+                self._transfer(filename, Item(group, identifier).path, move, overwrite)
+                return
+            with open(filename, "rb") as f:
+                group.append(identifier, f.read())
+            if move:
+                os.remove(filename)
+
+        # a group's shared lock is held only while its transfers are in flight, so a batch spanning
+        # many groups keeps a bounded number of lock files open
+        groups = dict()
+        releases = dict()
+        remaining = {group_uri: len(items) for group_uri, items in planned.items()}
+        pending = ((group_uri, identifier, filename) for group_uri in sorted(planned) for identifier, filename in planned[group_uri])
+        try:
+            # transfer on the pool, keeping a bounded number of files in flight
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                in_flight = dict()
+                while True:
+                    for group_uri, identifier, filename in pending:
+                        if group_uri not in releases:
+                            releases[group_uri] = self.locks.acquire(group_uri)
+                            groups[group_uri] = self._open_group(group_uri)
+                        future = executor.submit(put_one, identifier, *groups[group_uri], filename)
+                        in_flight[future] = (identifier, group_uri)
+                        if len(in_flight) >= workers * 4:
+                            break
+                    if not in_flight:
+                        break
+
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        identifier, group_uri = in_flight.pop(future)
+                        try:
+                            future.result()
+                        except FileExistsError:
+                            # another process published it first
+                            result.conflicts.append(identifier)
+                        except Exception as e:
+                            result.failures[identifier] = e
+                        else:
+                            # membership is updated on this thread only
+                            if overwrite and self.read_cache is not None:
+                                self.read_cache.invalidate(identifier)
+                            groups[group_uri][0].add(identifier)
+                            if self.manifest is not None:
+                                self.manifest.touch(group_uri)
+                            result.succeeded.append(identifier)
+                        remaining[group_uri] -= 1
+                        if not remaining[group_uri]:
+                            releases.pop(group_uri)()
+        finally:
+            for release in releases.values():
+                release()
+
+        if self.metrics.enabled:
+            self.metrics.count("put_many.items", len(result.succeeded))
+        return result
+
+    @timed("compact")
+    def compact(self, codec="gzip", compresslevel=None, workers=1, progress=None):
+        """
+        compact every full group into a tarball, ignoring GroupNotFullError.
+        groups that are already tarballs, or not full according to their bitmap, are skipped without touching their items.
+        groups are compacted on a pool of worker threads; progress, if given, is called with each CompactionReport.
+        a group that fails is reported with its error, and the other groups are still compacted.
+        returns the list of CompactionReports.
+        """
+        candidates = [
+            group for group in self.groups.values()
+            if not group.is_tarball and group.count >= group._bucket_size
+        ]
+
+        reports = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(group.timed_compact, codec=codec, compresslevel=compresslevel): group
+                for group in candidates
+            }
+            for future, group in futures.items():
+                try:
+                    report = future.result()
+                except GroupNotFullError:
+                    continue
+                except Exception as e:
+                    logger.warning("could not compact %s", group, exc_info=True)
+                    report = CompactionReport(group, 0.0, 0, 0, error=e)
+                if report is None:
+                    continue
+                reports.append(report)
+                if self.manifest is not None and report.ok:
+                    self.manifest.record(report.group.uri, tarball=True)
+                if progress is not None:
+                    progress(report)
+
+        if self.manifest is not None and self.manifest.dirty:
+            self.manifest.save()
+        if self.blobs is not None and any(report.ok for report in reports):
+            # the compacted items no longer link to their blobs
+            self.blobs.collect()
+
+        return reports
+
+    @timed("recompress")
+    def recompress(self, codec="gzip", compresslevel=None, workers=1, progress=None, source_codecs=None):
+        """
+        rewrite compacted groups with another codec or level.
+        groups already using codec are skipped unless compresslevel is given; source_codecs, if given, limits which groups are rewritten.
+        returns the list of CompactionReports.
+        """
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec}, expected one of {', '.join(CODECS)}")
+        candidates = [
+            group for group in self.groups.values()
+            if group.is_tarball
+            and (source_codecs is None or group.codec in source_codecs)
+            and (group.codec != codec or compresslevel is not None)
+        ]
+
+        reports = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(group.timed_recompress, codec=codec, compresslevel=compresslevel)
+                for group in candidates
+            ]
+            for future in futures:
+                report = future.result()
+                reports.append(report)
+                if progress is not None:
+                    progress(report)
+
+        return reports
+
+    @property
+    def stats(self):
+        "metrics, tarball handle pool, group lock, read cache and dedup statistics"
+        return {
+            "metrics": self.metrics.snapshot,
+            "handles": self.handles.stats,
+            "locks": self.locks.stats,
+            "cache": self.read_cache.stats if self.read_cache is not None else None,
+            "dedup": self.blobs.stats if self.blobs is not None else None,
+        }
 
     @property
     def is_valid(self):
         "check that the index is valid"
         return self.validate() is True
 
-    def validate(self, raise_exception=False, debug=False):
-        "check that the index is valid"
-        for group_uri in self.groups:
-            group = self.get_group(group_uri)
-            validation_result = group.validate(
-                raise_exception=raise_exception,
-                debug=debug
-            )
-            group.close()
-        return True
+    def validate(self, raise_exception=False, debug=False, quick=False, workers=1, progress=None):
+        """
+        check that the index is valid, validating groups on a pool of worker threads.
+        progress, if given, is called with (group, result) for each group.
+        returns True, or a dict of group uri to the exception for each invalid group.
+        """
+        invalid = dict()
+
+        def validate_group(group):
+            try:
+                return group.validate(raise_exception=raise_exception, debug=debug, quick=quick)
+            finally:
+                group.close()
+
+        groups = list(self.groups.values())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for group, result in zip(groups, executor.map(validate_group, groups)):
+                if result is not True:
+                    invalid[group.uri] = result
+                if progress is not None:
+                    progress(group, result)
+        return invalid or True
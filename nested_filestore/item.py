@@ -1,5 +1,6 @@
+import io
 import os
-import time
+import mmap
 
 
 class Item:
@@ -8,22 +9,66 @@ class Item:
         self.identifier = str(identifier)
 
     def open(self):
+        metrics = self.group.index.metrics
+        if metrics.enabled:
+            with metrics.timer(f"open.{self.storage}"):
+                return self._open()
+        return self._open()
+
+    def _open(self):
         if self.inside_tarball:
-            tarball = self.group._ratarmount
-            info = tarball.getFileInfo(f"{self.uri}.bin")
-            if info is None:
-                raise FileNotFoundError(f"{self.uri}.bin not found inside tarball")
-            return tarball.open(info)
+            cache = self.group.index.read_cache
+            if cache is not None:
+                data = self._read_cached(cache)
+                if data is not None:
+                    return io.BytesIO(data)
+            with self.group.archive() as archive:
+                return archive.open(self.identifier)
+        elif self.inside_segment:
+            with self.group.segment() as segment:
+                return segment.open(self.identifier)
         else:
-            retries = 0
-            while True:
-                try:
-                    return open(self.path, "rb")
-                except FileNotFoundError:
-                    if retries > 100:
-                        raise FileNotFoundError(f"{self.path} not found")
-                    retries += 1
-                    time.sleep(0.1)
+            # writes are renamed into place, so an existing file is always complete
+            return open(self.path, "rb")
+
+    def buffer(self):
+        "return a read-only memoryview of the contents, memory-mapped where the storage allows it"
+        metrics = self.group.index.metrics
+        if metrics.enabled:
+            with metrics.timer(f"buffer.{self.storage}"):
+                return self._buffer()
+        return self._buffer()
+
+    def _buffer(self):
+        if self.inside_tarball:
+            cache = self.group.index.read_cache
+            if cache is not None:
+                data = self._read_cached(cache)
+                if data is not None:
+                    return memoryview(data)
+            with self.group.archive() as archive:
+                return archive.buffer(self.identifier)
+        if self.inside_segment:
+            with self.group.segment() as segment:
+                return segment.buffer(self.identifier)
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _read_cached(self, cache):
+        "return the contents of a compacted item through the read cache, or None if it is too large to cache"
+        tag = self.group.cache_tag
+        data = cache.get(self.identifier, tag)
+        if data is not None:
+            return data
+        with self.group.archive() as archive:
+            with archive.open(self.identifier) as f:
+                data = f.read(cache.max_item_bytes + 1)
+        if len(data) > cache.max_item_bytes:
+            return None
+        cache.put(self.identifier, data, tag)
+        return data
 
     def __repr__(self):
         return self.identifier
@@ -32,6 +77,17 @@ class Item:
     def inside_tarball(self):
         return self.group.is_tarball
 
+    @property
+    def inside_segment(self):
+        return self.group.is_segment
+
+    @property
+    def storage(self):
+        "where the contents are kept: tarball, segment or loose"
+        if self.inside_tarball:
+            return "tarball"
+        return "segment" if self.inside_segment else "loose"
+
     @property
     def uri(self):
         return f"{self.group.uri}/{self.identifier}"
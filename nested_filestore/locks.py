@@ -0,0 +1,101 @@
+import os
+import time
+import fcntl
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+LOCK_DIRECTORY = ".locks"
+
+
+class GroupLocks:
+    """
+    GroupLocks coordinates writers and compaction on the same groups across processes, using a flock'd lock file per group.
+    writers hold a shared lock, so they do not wait for each other; compaction holds an exclusive one.
+    readers take no lock: a file they have open stays readable after compaction removes it.
+    when disabled, every lock is a no-op and only the in-process thread locks apply.
+    """
+
+    def __init__(self, root, enabled=False):
+        self.root = root
+        self.enabled = enabled
+        self._directory = os.path.join(root, LOCK_DIRECTORY)
+        self._directory_ready = False
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            mode: {"acquired": 0, "contended": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+            for mode in ("shared", "exclusive")
+        }
+
+    def path(self, group_uri):
+        "the lock file for a group uri like /0/1"
+        return os.path.join(self._directory, group_uri.strip("/").replace("/", "-") + ".lock")
+
+    def shared(self, group_uri):
+        "context manager holding the group lock in shared mode"
+        if not self.enabled:
+            return nullcontext()
+        return self._hold(group_uri, exclusive=False)
+
+    def exclusive(self, group_uri):
+        "context manager holding the group lock in exclusive mode"
+        if not self.enabled:
+            return nullcontext()
+        return self._hold(group_uri, exclusive=True)
+
+    def acquire(self, group_uri, exclusive=False):
+        "take the group lock and return a function that releases it, for locks that outlive a with block"
+        if not self.enabled:
+            return lambda: None
+        fds = [self._lock(group_uri, exclusive)]
+
+        def release():
+            # releasing twice must not close a descriptor number that has since been reused
+            if fds:
+                os.close(fds.pop())
+
+        return release
+
+    @contextmanager
+    def _hold(self, group_uri, exclusive):
+        fd = self._lock(group_uri, exclusive)
+        try:
+            yield
+        finally:
+            # closing the descriptor releases the flock
+            os.close(fd)
+
+    def _lock(self, group_uri, exclusive):
+        if not self._directory_ready:
+            os.makedirs(self._directory, exist_ok=True)
+            self._directory_ready = True
+
+        # lock files are never removed, since unlinking a lock file another process holds would split the lock
+        fd = os.open(self.path(group_uri), os.O_RDWR | os.O_CREAT, 0o666)
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                waited = None
+            except BlockingIOError:
+                start = time.perf_counter()
+                fcntl.flock(fd, operation)
+                waited = time.perf_counter() - start
+        except BaseException:
+            os.close(fd)
+            raise
+
+        stats = self._stats["exclusive" if exclusive else "shared"]
+        with self._stats_lock:
+            stats["acquired"] += 1
+            if waited is not None:
+                stats["contended"] += 1
+                stats["wait_seconds"] += waited
+                stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        return fd
+
+    @property
+    def stats(self):
+        "acquisitions, contended acquisitions and time spent waiting, per lock mode"
+        with self._stats_lock:
+            return {"enabled": self.enabled, **{mode: dict(values) for mode, values in self._stats.items()}}
@@ -0,0 +1,114 @@
+import os
+import json
+import base64
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Manifest:
+    """
+    Manifest is a persistent snapshot of an Index, stored as a single file under the index root.
+    Each group records the mtime of its directory when it was scanned, so only groups that changed
+    since the snapshot need to be listed again at startup.
+    """
+
+    filename = ".nested-index.json"
+    version = 2
+
+    # directories modified this recently may still change within the same mtime tick
+    racy_window_ns = 2 * 1000 * 1000 * 1000
+
+    def __init__(self, index):
+        self.index = index
+        self.entries = dict()
+        self.dirty = False
+
+    @property
+    def path(self):
+        return os.path.join(self.index.path, self.filename)
+
+    @property
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        "read the manifest from disk; return the membership bitmap per group, or None if unusable"
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get("version") != self.version:
+            return None
+        if data.get("dimensions") != list(self.index.dimensions) or data.get("base") != self.index.base:
+            logger.warning("ignoring manifest %s: created with a different hierarchy", self.path)
+            return None
+
+        self.entries = dict()
+        snapshot = dict()
+        for group_uri, entry in data["groups"].items():
+            self.entries[group_uri] = {
+                "mtime_ns": entry.get("mtime_ns"),
+                "tarball": entry.get("tarball", False),
+            }
+            if "bitmap" in entry:
+                snapshot[group_uri] = base64.b64decode(entry["bitmap"])
+        self.dirty = False
+        return snapshot
+
+    def is_current(self, group_uri, mtime_ns):
+        "is the recorded state of this group still valid for the given directory mtime?"
+        entry = self.entries.get(group_uri)
+        if entry is None or entry["tarball"] or entry["mtime_ns"] is None:
+            return False
+        return entry["mtime_ns"] == mtime_ns
+
+    def record(self, group_uri, mtime_ns=None, tarball=False):
+        "remember the directory mtime observed before a group was listed"
+        if mtime_ns is not None and time.time_ns() - mtime_ns < self.racy_window_ns:
+            mtime_ns = None
+        entry = {"mtime_ns": mtime_ns, "tarball": tarball}
+        if self.entries.get(group_uri) != entry:
+            self.entries[group_uri] = entry
+            self.dirty = True
+
+    def touch(self, group_uri):
+        "forget the recorded mtime of a group, so it is listed again at the next startup"
+        entry = self.entries.get(group_uri)
+        if entry is None or entry["mtime_ns"] is not None:
+            self.entries[group_uri] = {"mtime_ns": None, "tarball": False}
+            self.dirty = True
+
+    def forget(self, group_uri):
+        if self.entries.pop(group_uri, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        "atomically write the manifest, using the current groups of the index"
+        groups = dict()
+        for group_uri, group in sorted(self.index.groups.items()):
+            entry = self.entries.get(group_uri, {"mtime_ns": None, "tarball": False})
+            if group.is_tarball:
+                groups[group_uri] = {"tarball": True}
+            else:
+                groups[group_uri] = {
+                    "mtime_ns": entry["mtime_ns"],
+                    "bitmap": base64.b64encode(group.bitmap).decode("ascii"),
+                }
+
+        data = {
+            "version": self.version,
+            "dimensions": list(self.index.dimensions),
+            "base": self.index.base,
+            "groups": groups,
+        }
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
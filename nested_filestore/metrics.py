@@ -0,0 +1,105 @@
+import time
+import functools
+import threading
+from contextlib import nullcontext
+
+
+_DISABLED = nullcontext()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter_ns() - self.start)
+
+
+class Metrics:
+    """
+    Metrics is a registry of counters and timers for the hot paths of an Index.
+    it is disabled by default, when count() returns at once and timer() returns a shared no-op context manager;
+    hot paths also check enabled before doing any work for it.
+    listeners, if any, are called with (kind, name, value) for every counter increment and timing, in nanoseconds.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._timers = dict()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+        for listener in self.listeners:
+            listener("count", name, n)
+
+    def timer(self, name):
+        "context manager recording how long its block takes under name"
+        if not self.enabled:
+            return _DISABLED
+        return _Timer(self, name)
+
+    def observe(self, name, elapsed_ns):
+        "record one timing in nanoseconds"
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = [0, 0, 0]
+            timer[0] += 1
+            timer[1] += elapsed_ns
+            timer[2] = max(timer[2], elapsed_ns)
+        for listener in self.listeners:
+            listener("time", name, elapsed_ns)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    @property
+    def snapshot(self):
+        "counters, and per timer its count, total, mean and max in seconds"
+        with self._lock:
+            return {
+                "counters": dict(sorted(self._counters.items())),
+                "timers": {
+                    name: {
+                        "count": count,
+                        "total_seconds": total / 1e9,
+                        "mean_seconds": total / count / 1e9,
+                        "max_seconds": longest / 1e9,
+                    }
+                    for name, (count, total, longest) in sorted(self._timers.items())
+                },
+            }
+
+
+def timed(name):
+    "decorator recording the duration of a method in self.metrics under name, doing nothing else while metrics are disabled"
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter_ns() - start)
+        return wrapper
+    return decorate
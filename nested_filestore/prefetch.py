@@ -0,0 +1,145 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Prefetcher watches the identifiers a reader asks for and, once they ascend steadily, warms the next groups
+    on background threads, so crossing into them does not wait on a cold group.
+    warming a compacted group opens its archive into the index handle pool, loading or building its index,
+    and asks the kernel to read the archive ahead; for a segment or loose items it asks the same of their files.
+    at most depth groups past the current one are warmed, and no more are scheduled while the groups warmed
+    but not yet reached add up to max_bytes, so read-ahead cannot flood the page cache.
+    """
+
+    def __init__(self, index, depth=2, max_bytes=256 * 1024 * 1024, workers=2, min_run=3, max_stride=16):
+        if depth < 1:
+            raise ValueError("prefetch depth must be at least 1")
+        self.index = index
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.min_run = min_run
+        self.max_stride = max_stride
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="nested-filestore-prefetch")
+        self._last = None
+        self._run = 0
+        self._group_id = None
+        # group id -> bytes advised, or None while it is being warmed, for groups ahead of the reader
+        self._ahead = OrderedDict()
+        self._pending = set()
+        self._closed = False
+        self._stats = {"scheduled": 0, "warmed": 0, "hits": 0, "bytes_advised": 0, "over_budget": 0, "errors": 0}
+
+    def observe(self, identifier):
+        "record a read of identifier, scheduling the next groups when reads are sequential"
+        identifier = int(identifier)
+        group_id = self.index.group_id(identifier)
+        with self._lock:
+            if self._closed:
+                return
+            if self._last is not None and 0 < identifier - self._last <= self.max_stride:
+                self._run += 1
+            else:
+                # a jump: the groups warmed so far will not be reached in order
+                self._run = 1
+                self._ahead.clear()
+            self._last = identifier
+
+            if group_id != self._group_id:
+                self._group_id = group_id
+                if group_id in self._ahead:
+                    self._stats["hits"] += 1
+                # groups behind the reader no longer count against the budget
+                for passed in [passed for passed in self._ahead if passed <= group_id]:
+                    del self._ahead[passed]
+            if self._run < self.min_run:
+                return
+
+            for next_id in range(group_id + 1, group_id + self.depth + 1):
+                if next_id in self._ahead:
+                    continue
+                budget = self.max_bytes - sum(size or 0 for size in self._ahead.values())
+                if budget <= 0:
+                    self._stats["over_budget"] += 1
+                    break
+                self._ahead[next_id] = None
+                self._stats["scheduled"] += 1
+                future = self._executor.submit(self._warm, next_id, budget)
+                self._pending.add(future)
+                future.add_done_callback(self._pending.discard)
+
+    def _warm(self, group_id, budget):
+        try:
+            size = self.warm(self.index.group_uri(group_id), budget)
+        except Exception:
+            logger.debug("could not prefetch group %s", group_id, exc_info=True)
+            with self._lock:
+                self._stats["errors"] += 1
+            size = 0
+        with self._lock:
+            if group_id in self._ahead:
+                self._ahead[group_id] = size
+            self._stats["warmed"] += 1
+            self._stats["bytes_advised"] += size
+        self.index.metrics.count("prefetch.warmed")
+
+    def warm(self, group_uri, max_bytes=None):
+        "load and warm one group now, asking the kernel to read at most max_bytes ahead; returns the bytes asked for"
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        group = self.index._find_group(group_uri)
+        if group is None:
+            return 0
+        if group.is_tarball:
+            with group.archive():
+                pass
+            return _will_need(group._path_archive, max_bytes)
+        if group.is_segment:
+            with group.segment():
+                pass
+            return _will_need(group._path_segment, max_bytes)
+        size = 0
+        for identifier in group.identifiers:
+            if size >= max_bytes:
+                break
+            size += _will_need(f"{group._path_dir}/{identifier}.bin", max_bytes - size)
+        return size
+
+    def wait(self):
+        "block until the groups scheduled so far are warmed"
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    def close(self):
+        "stop scheduling and wait for the groups being warmed"
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=True)
+
+    @property
+    def stats(self):
+        "groups scheduled and warmed, reads that reached a warmed group, bytes advised and budget stops"
+        with self._lock:
+            return dict(self._stats)
+
+
+def _will_need(path, max_bytes):
+    "ask the kernel to read up to max_bytes of a file into the page cache in the background; returns the bytes asked for"
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    try:
+        size = min(os.fstat(fd).st_size, max_bytes)
+        if size and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        return size
+    finally:
+        os.close(fd)
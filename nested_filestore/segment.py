@@ -0,0 +1,215 @@
+import io
+import os
+import zlib
+import time
+import struct
+import tarfile
+import threading
+
+from .archive import IndexedTar, MemberFile
+
+
+# a segment group is found by its index log, which is written after the data it points at
+SEGMENT = "segment"
+SEGMENT_EXTENSION = ".seg"
+SEGMENT_INDEX_EXTENSION = ".seg.idx"
+
+# one index log record per append: identifier, data offset, data size, crc32 of the data
+RECORD = struct.Struct("<QQQI")
+
+
+class Segment:
+    """
+    Segment is the append-only storage of one group: a tar of its members without the end-of-archive blocks,
+    plus an index log of fixed-size records locating each member.
+    appends are single O_APPEND writes, so they need no lock between processes; an item can be read
+    with one pread as soon as its record is in the log. the last record for an identifier wins.
+    a full segment is sealed into an uncompressed tarball by appending the end-of-archive blocks and renaming it.
+    """
+
+    def __init__(self, path, prefix, fsync="none", create=False):
+        self.path = path
+        self.index_path = path[:-len(SEGMENT_EXTENSION)] + SEGMENT_INDEX_EXTENSION
+        self.prefix = prefix
+        self.fsync = fsync
+        self.members = dict()
+        self.checksums = dict()
+        self.records = 0
+        self._lock = threading.Lock()
+        self._fd = None
+        self._log_fd = None
+        self._log_position = 0
+
+        flags = os.O_RDWR | os.O_APPEND | (os.O_CREAT if create else 0)
+        self._fd = os.open(path, flags, 0o666)
+        try:
+            self._log_fd = os.open(self.index_path, flags, 0o666)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self.refresh()
+
+    def refresh(self):
+        "read index log records appended since the last refresh, by this or another process; returns their identifiers"
+        with self._lock:
+            end = os.fstat(self._log_fd).st_size
+            length = (end - self._log_position) // RECORD.size * RECORD.size
+            if length <= 0:
+                return []
+            data = os.pread(self._log_fd, length, self._log_position)
+            self._log_position += len(data)
+
+            identifiers = []
+            for identifier, offset, size, crc32 in RECORD.iter_unpack(data):
+                identifier = str(identifier)
+                self.members[identifier] = (offset, size)
+                self.checksums[identifier] = (size, crc32)
+                identifiers.append(identifier)
+            self.records += len(identifiers)
+            return identifiers
+
+    def append(self, identifier, data, mtime=None):
+        "append one member and its index record; returns the (offset, size) of its data"
+        identifier = str(int(identifier))
+        data = bytes(data)
+        info = tarfile.TarInfo(f"{self.prefix}/{identifier}.bin")
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = time.time() if mtime is None else mtime
+        padding = -len(data) % tarfile.BLOCKSIZE
+        buffer = info.tobuf(tarfile.DEFAULT_FORMAT, "utf-8", "surrogateescape") + data + tarfile.NUL * padding
+
+        with self._lock:
+            written = os.write(self._fd, buffer)
+            if written != len(buffer):
+                raise OSError(f"short write appending {identifier} to {self.path}")
+            # with O_APPEND the descriptor is left at the end of this write, wherever other appenders put it
+            offset = os.lseek(self._fd, 0, os.SEEK_CUR) - padding - len(data)
+            if self.fsync != "none":
+                os.fsync(self._fd)
+
+            crc32 = zlib.crc32(data)
+            os.write(self._log_fd, RECORD.pack(int(identifier), offset, len(data), crc32))
+            if self.fsync != "none":
+                os.fsync(self._log_fd)
+            self.members[identifier] = (offset, len(data))
+            self.checksums[identifier] = (len(data), crc32)
+            self.records += 1
+        return offset, len(data)
+
+    def _locate(self, identifier):
+        identifier = str(identifier)
+        if identifier not in self.members:
+            self.refresh()
+        if identifier not in self.members:
+            raise FileNotFoundError(f"{identifier}.bin not found inside {self.path}")
+        return self.members[identifier]
+
+    def open(self, identifier):
+        offset, size = self._locate(identifier)
+        return MemberFile(self._fd, offset, size)
+
+    def buffer(self, identifier):
+        offset, size = self._locate(identifier)
+        return memoryview(os.pread(self._fd, size, offset))
+
+    def read_many(self, identifiers):
+        "yield (identifier, bytes) for the members that exist, in segment order"
+        found = sorted((self.members[identifier], identifier) for identifier in identifiers if identifier in self.members)
+        for (offset, size), identifier in found:
+            yield identifier, os.pread(self._fd, size, offset)
+
+    def read_all(self):
+        yield from self.read_many(list(self.members))
+
+    def is_clean(self):
+        "whether the segment holds exactly one tar member per indexed identifier and nothing else"
+        if self.records != len(self.members):
+            # some identifiers were appended more than once
+            return False
+        with tarfile.open(self.path, mode="r:") as tarball:
+            return IndexedTar.offsets(tarball) == self.members and len(tarball.getmembers()) == len(self.members)
+
+    def seal(self, tarball_path):
+        """
+        turn a clean segment into an uncompressed tarball with its sidecar, without copying the members.
+        returns False if the segment first needs rewriting, because it has superseded or unindexed data.
+        """
+        self.refresh()
+        with self._lock:
+            if not self.is_clean():
+                return False
+            os.write(self._fd, tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+            if self.fsync != "none":
+                os.fsync(self._fd)
+            size = os.fstat(self._fd).st_size
+            # the sidecar names the sealed size, so it is ignored unless the rename happens
+            IndexedTar.write_sidecar(tarball_path, self.members, size=size, checksums=self.checksums)
+            os.rename(self.path, tarball_path)
+            os.remove(self.index_path)
+        return True
+
+    def remove(self):
+        "delete the segment files, after its members have been written elsewhere"
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        for name in ("_fd", "_log_fd"):
+            fd = getattr(self, name)
+            if fd is not None:
+                os.close(fd)
+                setattr(self, name, None)
+
+    def __del__(self):
+        self.close()
+
+
+class SegmentWriter(io.BytesIO):
+    """
+    SegmentWriter buffers a written item in memory and appends it to a group segment when it is closed.
+    on_commit is called once the item is appended, on_close once it is appended or discarded.
+    append, if given, is called with the contents instead of appending them to the group directly.
+    leaving a with block because of an exception discards the item instead.
+    """
+
+    def __init__(self, group, identifier, on_commit=None, on_close=None, append=None):
+        super().__init__()
+        self.group = group
+        self.identifier = identifier
+        self.on_commit = on_commit
+        self.on_close = on_close
+        self._append = append
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            data = self.getvalue()
+            super().close()
+            if self._append is not None:
+                self._append(data)
+            else:
+                self.group.append(self.identifier, data)
+            if self.on_commit is not None:
+                self.on_commit()
+        finally:
+            self._closed()
+
+    def discard(self):
+        super().close()
+        self._closed()
+
+    def _closed(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
@@ -0,0 +1,205 @@
+import os
+import errno
+import shutil
+import secrets
+
+
+# errors meaning the kernel cannot copy between these two files, so try the next method
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+# errors meaning the filesystem cannot hard link, so fall back to a check and rename
+_NO_LINK = {errno.EPERM, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EMLINK}
+
+
+FSYNC_POLICIES = ("none", "file", "dir")
+
+
+def temp_path(path):
+    "a hidden, unique temporary path in the same directory as path"
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{secrets.token_hex(6)}.tmp")
+
+
+def publish(src, dst, overwrite=True):
+    """
+    rename src to dst; without overwrite, hard link and unlink instead, so an existing dst is never replaced
+    even when another process publishes it at the same moment. raises FileExistsError in that case.
+    """
+    if overwrite:
+        os.replace(src, dst)
+        return
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise FileExistsError(errno.EEXIST, "already exists", dst)
+    except OSError as e:
+        if e.errno not in _NO_LINK:
+            raise
+        if os.path.exists(dst):
+            raise FileExistsError(errno.EEXIST, "already exists", dst)
+        os.rename(src, dst)
+        return
+    os.remove(src)
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AtomicWriter:
+    """
+    AtomicWriter is a writable file that is renamed into place when it is closed, so readers never see a partial file.
+    fsync is one of "none", "file" (sync the file before the rename) or "dir" (also sync the directory after it).
+    on_commit, if given, is called once the file is in place; on_close, if given, is called once it is committed or discarded.
+    without overwrite, closing raises FileExistsError if the path exists by then.
+    leaving a with block because of an exception discards the temporary file instead.
+    """
+
+    def __init__(self, path, fsync="none", on_commit=None, overwrite=True, on_close=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync}, expected one of {', '.join(FSYNC_POLICIES)}")
+        self.path = path
+        self.tmp_path = temp_path(path)
+        self.fsync = fsync
+        self.on_commit = on_commit
+        self.overwrite = overwrite
+        self.on_close = on_close
+        try:
+            fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except BaseException:
+            self._closed()
+            raise
+        self._file = os.fdopen(fd, "wb")
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        "flush the file and rename it into place"
+        if self._file.closed:
+            return
+        try:
+            self._file.flush()
+            if self.fsync != "none":
+                os.fsync(self._file.fileno())
+            self._file.close()
+            try:
+                self._publish()
+            except BaseException:
+                self.discard()
+                raise
+            if self.fsync == "dir":
+                fsync_directory(os.path.dirname(self.path))
+            if self.on_commit is not None:
+                self.on_commit()
+        finally:
+            self._closed()
+
+    def _publish(self):
+        publish(self.tmp_path, self.path, overwrite=self.overwrite)
+
+    def discard(self):
+        "close and remove the temporary file without publishing it"
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+        self._closed()
+
+    def _closed(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close()
+
+
+class BulkPutResult:
+    "summary of a put_many call"
+
+    def __init__(self):
+        self.succeeded = []
+        self.conflicts = []
+        self.failures = dict()
+
+    @property
+    def ok(self):
+        return len(self.conflicts) == 0 and len(self.failures) == 0
+
+    def __repr__(self):
+        return f"BulkPutResult(succeeded={len(self.succeeded)}, conflicts={len(self.conflicts)}, failures={len(self.failures)})"
+
+
+def copy_file(src, dst, fsync="none", overwrite=True):
+    "atomically copy src to dst inside the kernel, using copy_file_range, then sendfile, then a read/write loop"
+    with open(src, "rb") as fsrc, AtomicWriter(dst, fsync=fsync, overwrite=overwrite) as fdst:
+        copy_fileobj(fsrc, fdst)
+        shutil.copymode(src, fdst.tmp_path)
+
+
+def copy_fileobj(fsrc, fdst):
+    "copy the remainder of fsrc into fdst, both being real files"
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    offset = os.lseek(infd, 0, os.SEEK_CUR)
+    size = os.fstat(infd).st_size
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(infd, outfd, size - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    try:
+        while offset < size:
+            copied = os.sendfile(outfd, infd, offset, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+
+    fsrc.seek(offset)
+    shutil.copyfileobj(fsrc, fdst)
+
+
+def move_file(src, dst, fsync="none", overwrite=True):
+    "atomically rename src to dst, copying instead when they are on different filesystems"
+    try:
+        if fsync != "none":
+            with open(src, "rb") as f:
+                os.fsync(f.fileno())
+        publish(src, dst, overwrite=overwrite)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(src, dst, fsync=fsync, overwrite=overwrite)
+        os.remove(src)
+        return
+    if fsync == "dir":
+        fsync_directory(os.path.dirname(dst))
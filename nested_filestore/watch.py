@@ -0,0 +1,242 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from .archive import CODECS, archive_codec
+from .segment import SEGMENT, SEGMENT_INDEX_EXTENSION
+
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+ADDED = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+REMOVED = IN_MOVED_FROM | IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    "minimal inotify binding through ctypes"
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self, timeout):
+        "wait up to timeout seconds, then yield (wd, mask, name) for each pending event"
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        position = 0
+        while position < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, position)
+            position += _EVENT.size
+            name = data[position:position + length].rstrip(b"\0").decode(errors="surrogateescape")
+            position += length
+            yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Watcher keeps an Index current with items and groups that other processes add, remove or compact under its root.
+    with inotify, every directory down to the group directories is watched and each event updates one group;
+    with polling, the directory levels are walked every interval seconds and only groups whose mtime changed are listed.
+    segments are followed through their index log, so only the records appended since the last change are read.
+    it starts with a full pass, since the index may already be out of date, and falls back to polling
+    when inotify is unavailable or runs out of watches.
+    items are taken to be complete when they appear, which holds for files the filestore writes.
+    """
+
+    def __init__(self, index, backend="auto", interval=1.0):
+        if backend not in ("auto", "inotify", "poll"):
+            raise ValueError(f"unknown watch backend {backend}, expected auto, inotify or poll")
+        self.index = index
+        self.backend = backend
+        self.interval = interval
+        self.events = 0
+        self._depth = len(index.dimensions) - 1
+        self._mtimes = dict()
+        self._watches = dict()
+        self._inotify = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.backend != "poll":
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                if self.backend == "inotify":
+                    raise
+                logger.info("inotify is unavailable, polling instead: %s", e)
+        self.backend = "inotify" if self._inotify is not None else "poll"
+        if self._inotify is not None:
+            self._watch_tree(self.index.path, "", 0)
+        self.poll()
+        self._thread = threading.Thread(target=self._run, name="nested-filestore-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._inotify is not None:
+                    self._read_events()
+                else:
+                    self._stopped.wait(self.interval)
+                    if not self._stopped.is_set():
+                        self.poll()
+            except Exception:
+                logger.exception("watcher for %s failed to apply a change", self.index.path)
+
+    def poll(self):
+        "walk the directory levels once, reloading groups that changed since the last pass"
+        seen = set()
+        now = time.time_ns()
+        for group_uri, codec, mtime_ns in self.index._walk():
+            seen.add(group_uri)
+            if codec is not None and codec != SEGMENT:
+                group = self.index.groups.get(group_uri)
+                if group is None or group._is_tarball is not True or group._codec != codec:
+                    self._reload(group_uri)
+            elif self._mtimes.get(group_uri) != mtime_ns or group_uri not in self.index.groups:
+                self._reload(group_uri)
+                # a directory changed within the timestamp granularity could change again unnoticed; list it next time too
+                self._mtimes[group_uri] = mtime_ns if now - mtime_ns > 2_000_000_000 else None
+        for group_uri in list(self.index.groups):
+            if group_uri not in seen:
+                self._mtimes.pop(group_uri, None)
+                self._reload(group_uri)
+
+    def _reload(self, group_uri):
+        self.events += 1
+        self.index.metrics.count("watch.reload")
+        self.index.reload_group(group_uri)
+
+    def _watch_tree(self, path, uri, level):
+        "watch path and the directories below it, down to the group directories"
+        if not self._add_watch(path, uri, level):
+            return
+        if level > self._depth - 1:
+            return
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.startswith(".") and entry.is_dir():
+                self._watch_tree(entry.path, f"{uri}/{entry.name}", level + 1)
+
+    def _add_watch(self, path, uri, level):
+        try:
+            wd = self._inotify.add_watch(path, WATCH_MASK)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            if e.errno == errno.ENOSPC:
+                logger.warning("out of inotify watches, polling %s instead", self.index.path)
+                self._inotify.close()
+                self._inotify = None
+                self.backend = "poll"
+                return False
+            raise
+        self._watches[wd] = (path, uri, level)
+        return True
+
+    def _read_events(self):
+        for wd, mask, name in self._inotify.read(timeout=0.2):
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so look at everything again
+                self.poll()
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches or not name or name.startswith("."):
+                continue
+            path, uri, level = self._watches[wd]
+            self.events += 1
+            self.index.metrics.count("watch.events")
+            self._apply(path, uri, level, mask, name)
+            if self._inotify is None:
+                return
+
+    def _apply(self, path, uri, level, mask, name):
+        is_dir = mask & IN_ISDIR
+        if level == self._depth:
+            # an item in a group directory
+            if not is_dir and name.endswith(".bin"):
+                self.index.update_item(uri, name[:-len(".bin")], present=not mask & REMOVED)
+        elif level == self._depth - 1:
+            # a group directory, a segment or a compacted group
+            if is_dir:
+                if mask & ADDED:
+                    self._watch_tree(os.path.join(path, name), f"{uri}/{name}", level + 1)
+                self.index.reload_group(f"{uri}/{name}")
+            elif (codec := archive_codec(name)) is not None and mask & (REMOVED | IN_CLOSE_WRITE | IN_MOVED_TO):
+                # an archive only counts once it is completely written or renamed into place
+                self.index.reload_group(f"{uri}/{name[:-len(CODECS[codec])]}")
+            elif name.endswith(SEGMENT_INDEX_EXTENSION):
+                # every append writes a record to the index log
+                self.index.reload_group(f"{uri}/{name[:-len(SEGMENT_INDEX_EXTENSION)]}")
+        elif is_dir and mask & ADDED:
+            # a new directory level; groups may have appeared in it before it was watched
+            self._watch_tree(os.path.join(path, name), f"{uri}/{name}", level + 1)
+            for group_uri, _, _ in self.index._walk():
+                if group_uri.startswith(f"{uri}/{name}/") and group_uri not in self.index.groups:
+                    self.index.reload_group(group_uri)
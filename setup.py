@@ -29,6 +29,15 @@ setup(
             "pylint",
             "ipython",
         ],
+        "numpy": [
+            "numpy",
+        ],
+        "zstd": [
+            "zstandard",
+        ],
+        "lz4": [
+            "lz4",
+        ],
         "docs": [
             "sphinx",
             "sphinx_rtd_theme",
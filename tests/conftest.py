@@ -25,3 +25,16 @@ def index_filestore():
 def little_index_filestore():
     shutil.rmtree("/tmp/filestore", ignore_errors=True)
     return Index(path="/tmp/filestore", dimensions=[1, 1, 1])
+
+@pytest.fixture()
+def segment_filestore():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    yield NestedFilestore("/tmp/filestore", [1, 1, 1], storage="segment")
+    # later tests expect an empty /tmp/filestore
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+
+@pytest.fixture()
+def dedup_filestore():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    yield NestedFilestore("/tmp/filestore", [1, 1, 1], dedup=True)
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
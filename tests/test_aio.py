@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+import pytest
+
+from nested_filestore import AsyncNestedFilestore, NestedFilestore
+
+
+def test_async_workflow(filestore):
+    async def workflow():
+        async with AsyncNestedFilestore(filestore, max_workers=2) as afs:
+            assert not await afs.exists(12345678)
+            await afs.put(12345678, "tests/data/12345678.bin")
+            assert await afs.exists(12345678)
+            assert filestore.exists(12345678)
+
+            async with await afs.get(12345678) as f:
+                assert await f.read() == b"hi"
+
+            async with await afs.writer(1234) as fh:
+                await fh.write(b"async")
+            with filestore.get(1234) as f:
+                assert f.read() == b"async"
+            # a group lock is dropped once no put holds it
+            assert afs._group_locks == {}
+
+            with pytest.raises(ValueError):
+                await afs.get(5)
+
+            results = [result async for result in afs.get_many([1234, 5, 12345678])]
+            assert results == [(1234, b"async"), (5, None), (12345678, b"hi")]
+
+    asyncio.run(workflow())
+
+def test_async_tarball():
+    async def read():
+        filestore = NestedFilestore("tests/data/filestore-1-1-1", [1, 1, 1])
+        async with AsyncNestedFilestore(filestore) as afs:
+            reads = [afs.get(identifier) for identifier in range(10, 20)]
+            for reader in await asyncio.gather(*reads):
+                async with reader as f:
+                    assert await f.read() == b"hi"
+
+    asyncio.run(read())
+
+def test_async_lazy_lookups_off_loop():
+    async def lookup():
+        filestore = NestedFilestore("tests/data/filestore-1-1-1", [1, 1, 1], sync="lazy")
+        threads = []
+        find_group = filestore.index._find_group
+
+        def recording_find_group(group_uri):
+            threads.append(threading.current_thread())
+            return find_group(group_uri)
+
+        filestore.index._find_group = recording_find_group
+        async with AsyncNestedFilestore(filestore) as afs:
+            assert await afs.exists(420)
+            async with await afs.get(11) as f:
+                assert await f.read() == b"hi"
+        assert threads and threading.main_thread() not in threads
+
+    asyncio.run(lookup())
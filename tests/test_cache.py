@@ -0,0 +1,97 @@
+import os
+import shutil
+
+from nested_filestore import NestedFilestore, ReadCache
+
+
+def test_read_cache_lru():
+    cache = ReadCache(max_bytes=10, max_item_bytes=10)
+    cache.put(1, b"aaaa")
+    cache.put(2, b"bbbb")
+    assert cache.get(1) == b"aaaa"
+    cache.put(3, b"cccc")
+    # 2 was least recently used
+    assert cache.get(2) is None
+    assert cache.get(3) == b"cccc"
+    cache.put(4, b"x" * 11)
+    assert cache.get(4) is None
+    assert cache.stats["hits"] == 2
+    assert cache.stats["misses"] == 2
+    assert cache.stats["bytes_served"] == 8
+
+def test_read_cache_disk_tier():
+    shutil.rmtree("/tmp/filestore-cache", ignore_errors=True)
+    cache = ReadCache(max_bytes=4, directory="/tmp/filestore-cache", max_disk_bytes=8, max_item_bytes=4)
+    for identifier in range(1, 5):
+        cache.put(identifier, f"{identifier}abc".encode())
+    # 4 is in memory, 1 fell off the disk tier, 2 and 3 spilled to disk
+    assert cache.stats["disk_items"] == 2
+    assert cache.get(2) == b"2abc"
+    assert cache.stats["disk_hits"] == 1
+    # promoting 2 spilled 4 to disk, which pushed out 3
+    assert cache.stats["disk_items"] == 2
+
+    reopened = ReadCache(max_bytes=4, directory="/tmp/filestore-cache", max_disk_bytes=8, max_item_bytes=4)
+    assert reopened.get(4) == b"4abc"
+    assert reopened.get(3) is None
+    reopened.invalidate_range(0, 10)
+    assert reopened.stats["disk_items"] == 0
+    assert not os.listdir("/tmp/filestore-cache/04")
+    shutil.rmtree("/tmp/filestore-cache")
+
+def test_read_cache_compacted_items():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    cache = ReadCache(max_bytes=1024)
+    filestore = NestedFilestore("/tmp/filestore", [1, 1, 1], read_cache=cache)
+    for i in range(0, 10):
+        filestore.put(i, filename="tests/data/12345678.bin")
+    filestore.put(12, filename="tests/data/12345678.bin")
+
+    with filestore.get(12) as f:
+        assert f.read() == b"hi"
+    assert cache.stats["misses"] == 0
+
+    filestore.compact(codec="gzip")
+    for _ in range(3):
+        with filestore.get(4) as f:
+            assert f.read() == b"hi"
+    assert bytes(filestore.get_buffer(4)) == b"hi"
+    assert cache.stats["misses"] == 1
+    assert cache.stats["hits"] == 3
+    assert filestore.index.stats["cache"]["hit_ratio"] == 0.75
+
+    filestore.recompress(codec="none")
+    assert cache.stats["memory_items"] == 0
+    filestore.close()
+    shutil.rmtree("/tmp/filestore")
+
+def test_read_cache_disk_tier_checks_archive():
+    for path in ("/tmp/filestore", "/tmp/filestore-other", "/tmp/filestore-cache"):
+        shutil.rmtree(path, ignore_errors=True)
+    for path, source in (("/tmp/filestore", "tests/data/12345678.bin"), ("/tmp/filestore-other", "tests/data/12345679.bin")):
+        filestore = NestedFilestore(path, [1, 1, 1])
+        for i in range(0, 10):
+            filestore.put(i, filename=source)
+        filestore.compact(codec="none")
+        filestore.close()
+
+    def read(path):
+        cache = ReadCache(max_bytes=0, directory="/tmp/filestore-cache", max_item_bytes=16)
+        filestore = NestedFilestore(path, [1, 1, 1], read_cache=cache)
+        with filestore.get(4) as f:
+            data = f.read()
+        filestore.close()
+        return data, cache.stats["disk_hits"]
+
+    assert read("/tmp/filestore") == (b"hi", 0)
+    assert read("/tmp/filestore") == (b"hi", 1)
+    # another store sharing the cache directory has its own entries
+    assert read("/tmp/filestore-other") == (b"bye", 0)
+    assert read("/tmp/filestore") == (b"hi", 0)
+
+    # the group is rewritten while no cache is open
+    for name in ("0.tar", "0.tar.idx"):
+        shutil.copy(f"/tmp/filestore-other/0/{name}", f"/tmp/filestore/0/{name}")
+    assert read("/tmp/filestore") == (b"bye", 0)
+    for path in ("/tmp/filestore", "/tmp/filestore-other", "/tmp/filestore-cache"):
+        shutil.rmtree(path)
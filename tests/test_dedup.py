@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from nested_filestore.index import Index
+
+
+def test_dedup_put(dedup_filestore):
+    for i in range(0, 5):
+        dedup_filestore.put(i, filename="tests/data/12345678.bin")
+    with dedup_filestore.writer(5) as f:
+        f.write(b"h")
+        f.write(b"i")
+    dedup_filestore.put(6, filename="tests/data/12345679.bin")
+
+    # identical items are hard links to one blob
+    assert os.stat("/tmp/filestore/0/0/0.bin").st_ino == os.stat("/tmp/filestore/0/0/5.bin").st_ino
+    assert os.stat("/tmp/filestore/0/0/0.bin").st_nlink == 7
+    with dedup_filestore.get(5) as f:
+        assert f.read() == b"hi"
+    with dedup_filestore.get(6) as f:
+        assert f.read() == b"bye"
+
+    stats = dedup_filestore.index.stats["dedup"]
+    assert stats["items"] == 7
+    assert stats["duplicates"] == 5
+    assert stats["bytes_saved"] == 10
+    usage = dedup_filestore.index.blobs.usage()
+    assert usage["blobs"] == 2
+    assert usage["references"] == 7
+    assert usage["bytes_saved"] == 10
+
+    with pytest.raises(ValueError):
+        dedup_filestore.put(6, filename="tests/data/12345678.bin")
+    dedup_filestore.put(6, filename="tests/data/12345678.bin", overwrite=True)
+    with dedup_filestore.get(6) as f:
+        assert f.read() == b"hi"
+    # the blob of the replaced item is no longer referenced
+    assert dedup_filestore.index.blobs.collect() == 3
+    assert dedup_filestore.index.blobs.usage()["blobs"] == 1
+
+@pytest.mark.parametrize("codec", ["none", "gzip", "zstd"])
+def test_dedup_compact(dedup_filestore, codec):
+    for i in range(0, 10):
+        dedup_filestore.put(i, filename="tests/data/12345679.bin" if i == 3 else "tests/data/12345678.bin")
+    assert len(dedup_filestore.compact(codec=codec)) == 1
+
+    # one copy of each payload is stored, the other members link to it
+    assert dedup_filestore.index.stats["dedup"]["archive_bytes_saved"] == 16
+    assert dedup_filestore.index.blobs.usage()["blobs"] == 0
+    assert dedup_filestore.index.validate() is True
+    assert dedup_filestore.index.validate(quick=True) is True
+    assert dict(dedup_filestore.iter_range(0, 10))[3] == b"bye"
+
+    reopened = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    for i in range(0, 10):
+        with reopened.get(i).open() as f:
+            assert f.read() == (b"bye" if i == 3 else b"hi")
+    assert sorted(data for _, data in reopened.get_group("/0/0").read_all()) == [b"bye"] + [b"hi"] * 9
+
+@pytest.mark.parametrize("codec", ["none", "gzip"])
+def test_dedup_compact_without_dedup(dedup_filestore, codec):
+    for i in range(0, 10):
+        dedup_filestore.put(i, filename="tests/data/12345678.bin")
+    # a plain index, as nested-manager.py compact uses, stores every linked item in full
+    plain = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    assert len(plain.compact(codec=codec)) == 1
+    assert not os.path.exists("/tmp/filestore/0/0/0.bin")
+    assert plain.validate() is True
+
+    reopened = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    for i in range(0, 10):
+        with reopened.get(i).open() as f:
+            assert f.read() == b"hi"
+    assert reopened.validate() is True
@@ -0,0 +1,42 @@
+import json
+import shutil
+
+import pytest
+
+from nested_filestore import NestedFilestore, ExportedRange
+
+
+def test_export_range():
+    np = pytest.importorskip("numpy")
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    shutil.rmtree("/tmp/filestore-export", ignore_errors=True)
+    filestore = NestedFilestore("/tmp/filestore", [1, 1, 1])
+    for i in range(0, 10):
+        filestore.put(i, filename="tests/data/12345678.bin")
+    filestore.compact(codec="gzip")
+    filestore.put(12, filename="tests/data/12345679.bin")
+    filestore.put(14, filename="tests/data/12345678.bin")
+
+    summary = filestore.export_range(8, 16, "/tmp/filestore-export")
+    assert (summary["items"], summary["missing"], summary["bytes"]) == (4, 4, 9)
+
+    offsets = np.load("/tmp/filestore-export/offsets.npy", mmap_mode="r")
+    missing = np.load("/tmp/filestore-export/missing.npy", mmap_mode="r")
+    data = np.memmap("/tmp/filestore-export/data.bin", dtype=np.uint8, mode="r")
+    assert offsets["identifier"].tolist() == list(range(8, 16))
+    assert missing.tolist() == [False, False, True, True, False, True, False, True]
+    row = 12 - 8
+    assert data[offsets["offset"][row]:offsets["offset"][row] + offsets["length"][row]].tobytes() == b"bye"
+    with open("/tmp/filestore-export/meta.json") as f:
+        assert json.load(f)["bytes"] == 9
+
+    exported = ExportedRange("/tmp/filestore-export")
+    assert len(exported) == 8
+    assert bytes(exported[9]) == b"hi"
+    assert bytes(exported[14]) == b"hi"
+    assert exported[10] is None
+    with pytest.raises(KeyError):
+        exported[16]
+
+    shutil.rmtree("/tmp/filestore")
+    shutil.rmtree("/tmp/filestore-export")
@@ -0,0 +1,57 @@
+import threading
+
+from nested_filestore.index import Index
+from nested_filestore.handles import HandlePool
+
+
+class Handle:
+    def __init__(self, key):
+        self.key = key
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_handle_pool_lru():
+    pool = HandlePool(max_open=2)
+    opened = dict()
+
+    def lease(key):
+        return pool.lease(key, lambda: opened.setdefault(key, Handle(key)))
+
+    with lease("a"), lease("b"):
+        pass
+    with lease("a"):
+        pass
+    with lease("c") as c:
+        # "b" was least recently used
+        assert opened["b"].closed
+        assert not opened["a"].closed
+    assert pool.stats == {"open": 2, "max_open": 2, "hits": 1, "misses": 3, "evictions": 1}
+
+    # a leased handle is only closed once the lease ends
+    with lease("a") as a:
+        pool.discard("a")
+        assert not a.closed
+    assert a.closed
+    pool.clear()
+    assert c.closed and len(pool) == 0
+
+def test_index_handle_pool():
+    i = Index(path="tests/data/filestore-1-1-1", dimensions=[1,1,1], max_open_tarballs=1)
+
+    def read():
+        for identifier in range(10, 20):
+            with i.get(identifier).open() as f:
+                assert f.read() == b"hi"
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(i.handles) == 1
+    assert i.handles.misses >= 1
+    assert i.handles.hits + i.handles.misses == 40
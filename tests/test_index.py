@@ -1,7 +1,10 @@
 import os
+import json
+import shutil
 import pytest
 
 from nested_filestore.index import Index
+from nested_filestore.group import Group, GroupCache
 
 
 def test_sync():
@@ -106,3 +109,284 @@ def test_index_full(little_index_filestore):
 
     little_index_filestore.put(20, filename="tests/data/12345678.bin")
     assert os.path.exists("/tmp/filestore/0/2/20.bin")
+
+def test_manifest(little_index_filestore):
+    little_index_filestore.put(0, filename="tests/data/12345678.bin")
+    little_index_filestore.put(1, filename="tests/data/12345678.bin")
+    os.utime("/tmp/filestore/0/0", ns=(0, 0))
+    little_index_filestore.sync()
+    little_index_filestore.save()
+    assert os.path.isfile("/tmp/filestore/.nested-index.json")
+
+    # an unchanged group is restored from the manifest without listing its directory
+    os.remove("/tmp/filestore/0/0/1.bin")
+    os.utime("/tmp/filestore/0/0", ns=(0, 0))
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1])
+    assert i.exists(1)
+
+    # a group whose directory changed is listed again
+    os.utime("/tmp/filestore/0/0", ns=(10**9, 10**9))
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1])
+    assert i.exists(0)
+    assert not i.exists(1)
+
+def test_group_bitmap(little_index_filestore):
+    for i in [3, 5, 7]:
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    group = little_index_filestore.get_group("/0/0")
+    assert group.count == 3
+    assert group.min == "3"
+    assert group.max == "7"
+    assert list(group.identifiers) == [3, 5, 7]
+    assert group.missing == [0, 1, 2, 4, 6, 8, 9]
+    assert not group.exists(4)
+    assert not group.exists(13)
+    assert pytest.raises(ValueError, group.add, 13)
+
+def test_tarball_read():
+    i = Index(path="tests/data/filestore-1-1-1", dimensions=[1,1,1])
+    with i.get(11).open() as f:
+        assert f.read() == b"hi"
+    assert pytest.raises(ValueError, i.get, 21)
+
+def test_compact_uncompressed(little_index_filestore):
+    for i in range(0, 10):
+        little_index_filestore.put(i, filename="tests/data/12345679.bin")
+    group = little_index_filestore.get_group("/0/0")
+    assert group.compact(codec="none")
+    assert os.path.exists("/tmp/filestore/0/0.tar")
+    assert os.path.exists("/tmp/filestore/0/0.tar.idx")
+    assert group.path == "/tmp/filestore/0/0.tar"
+
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1])
+    assert i.get_group("/0/0").codec == "none"
+    with i.get(7).open() as f:
+        assert f.read(1) == b"b"
+        assert f.read() == b"ye"
+
+def test_compact_gzip(little_index_filestore):
+    for i in range(0, 10):
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    assert little_index_filestore.get_group("/0/0").compact()
+    assert os.path.exists("/tmp/filestore/0/0.tgz.index.sqlite")
+    with little_index_filestore.get(3).open() as f:
+        assert f.read() == b"hi"
+
+def test_compact_leftover_temp_file(little_index_filestore):
+    for i in range(0, 10):
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    # a writer that crashed leaves its temporary file behind
+    with open("/tmp/filestore/0/0/.5.bin.0123456789ab.tmp", "wb") as f:
+        f.write(b"partial")
+    assert little_index_filestore.get_group("/0/0").compact(codec="none")
+    assert not os.path.exists("/tmp/filestore/0/0")
+    assert not any(name.endswith(".tmp") for name in os.listdir("/tmp/filestore/0"))
+
+    # an existing archive is never rewritten
+    assert little_index_filestore.compact(codec="none") == []
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1], manifest=False)
+    assert i.validate() is True
+    with i.get(9).open() as f:
+        assert f.read() == b"hi"
+    shutil.rmtree("/tmp/filestore")
+
+def test_put_many(little_index_filestore):
+    little_index_filestore.put(1, filename="tests/data/12345678.bin")
+    sources = [(i, "tests/data/12345678.bin") for i in range(0, 25)] + [(3, "tests/data/12345679.bin")]
+    sources.append((30, "tests/data/does-not-exist.bin"))
+    result = little_index_filestore.put_many(sources, workers=4)
+
+    assert sorted(result.conflicts, key=int) == ["1", "3"]
+    assert list(result.failures) == ["30"]
+    assert len(result.succeeded) == 24
+    assert little_index_filestore.get_group("/0/0").is_full
+    assert little_index_filestore.exists(24)
+    assert not little_index_filestore.exists(30)
+    with little_index_filestore.get(3).open() as f:
+        assert f.read() == b"hi"
+
+def test_compact_workers(little_index_filestore):
+    little_index_filestore.put_many([(i, "tests/data/12345678.bin") for i in range(0, 35)])
+    seen = []
+    reports = little_index_filestore.compact(codec="none", workers=2, progress=seen.append)
+    assert sorted(report.group.uri for report in reports) == ["/0/0", "/0/1", "/0/2"]
+    assert len(seen) == 3
+    assert all(report.items == 10 and report.size > 0 for report in reports)
+    assert not little_index_filestore.get_group("/0/3").is_tarball
+
+    # compacted groups are skipped the next time
+    assert little_index_filestore.compact(codec="none") == []
+
+def test_lazy():
+    i = Index(path="tests/data/filestore-1-1-1", dimensions=[1,1,1], sync="lazy", max_groups=2)
+    assert len(i.groups) == 0
+    assert i.exists(420)
+    assert list(i.groups) == ["/4/2"]
+    assert i.exists(11)
+    assert i.get_group("/0/1").is_tarball
+    assert not i.exists(421)
+    assert not i.exists(9999)
+    assert i.exists(0)
+    assert list(i.groups) == ["/4/2", "/0/0"]
+    assert pytest.raises(ValueError, i.get_group, "/9/9")
+
+def test_lazy_put(little_index_filestore):
+    little_index_filestore.put(3, filename="tests/data/12345678.bin")
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1], sync="lazy")
+    assert pytest.raises(ValueError, i.put, 3, filename="tests/data/12345678.bin")
+    i.put(4, filename="tests/data/12345678.bin")
+    assert list(i.get_group("/0/0").identifiers) == [3, 4]
+    assert not os.path.exists("/tmp/filestore/.nested-index.json")
+
+    # new groups are created without taking the directory lock twice
+    result = i.put_many([(5, "tests/data/12345678.bin"), (25, "tests/data/12345678.bin")])
+    assert sorted(result.succeeded, key=int) == ["5", "25"]
+    assert i.exists(25)
+
+def test_lazy_absent_groups(little_index_filestore):
+    little_index_filestore.put(3, filename="tests/data/12345678.bin")
+    os.utime("/tmp/filestore/0", ns=(0, 0))
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1], sync="lazy", max_groups=2)
+    assert not i.exists(5)
+    assert not i.exists(25)
+    # an absent group is remembered until its parent directory changes
+    assert i.groups.is_absent("/0/2", 0)
+    little_index_filestore.put(25, filename="tests/data/12345678.bin")
+    assert i.exists(25)
+
+    # syncing a lazy index keeps its bounded cache
+    i.sync()
+    assert isinstance(i.groups, GroupCache)
+    assert list(i.groups) == ["/0/0", "/0/2"]
+    shutil.rmtree("/tmp/filestore")
+
+def test_sync_skips_stray_directories(little_index_filestore):
+    little_index_filestore.put(3, filename="tests/data/12345678.bin")
+    os.makedirs("/tmp/filestore/lost+found")
+    os.makedirs("/tmp/filestore/0/backup")
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1], manifest=False)
+    assert list(i.groups) == ["/0/0"]
+    assert i.exists(3)
+    shutil.rmtree("/tmp/filestore")
+
+def test_which_group_arithmetic():
+    i = Index(path="/tmp/filestore", dimensions=[3,3,3], sync=False)
+    assert i.which_group(12) == "/000/000"
+    assert i.which_group("123456789") == "/123/456"
+    # the top level grows instead of wrapping around
+    assert i.which_group(1234567890123) == "/1234567/890"
+    assert i.parse_group("/1234567/890") == i.group_id(1234567890123)
+
+    h = Index(path="/tmp/filestore", dimensions=[2,2,2], base=16, pad_character="_", sync=False)
+    assert h.which_group(0xabcdef12) == "/abcd/ef"
+    assert h.which_group(0x312) == "/_0/_3"
+    assert h.parse_group("/_0/_3") == 0x3
+
+def test_group_ids():
+    np = pytest.importorskip("numpy")
+    i = Index(path="/tmp/filestore", dimensions=[3,3,3], sync=False)
+    identifiers = np.array([0, 999, 1000, 123456789])
+    assert i.group_ids(identifiers).tolist() == [0, 0, 1, 123456]
+    assert i.group_uri(123456) == i.which_group(123456789)
+
+def test_missing_ranges():
+    i = Index(path="tests/data/filestore-1-1-1", dimensions=[1,1,1])
+    assert list(i.missing_ranges()) == [(2, 10), (20, 50), (51, 100), (101, 150), (151, 420)]
+    assert list(i.missing_ranges(0, 12)) == [(2, 10)]
+    assert list(i.missing_ranges(415, 430)) == [(415, 420), (421, 430)]
+    assert list(i.missing) == [idx for idx in range(0, 421) if not i.exists(idx)]
+
+    group = i.get_group("/0/0")
+    assert group.missing_ranges() == [(2, 10)]
+    assert i.get_group("/0/1").missing_ranges() == []
+
+def test_compact_zstd(little_index_filestore):
+    pytest.importorskip("zstandard")
+    for i in range(0, 10):
+        little_index_filestore.put(i, filename="tests/data/12345679.bin")
+    group = little_index_filestore.get_group("/0/0")
+    assert group.compact(codec="zstd", compresslevel=10)
+    assert os.path.exists("/tmp/filestore/0/0.zst.tar")
+    assert os.path.exists("/tmp/filestore/0/0.zst.tar.idx")
+
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1])
+    assert i.get_group("/0/0").codec == "zstd"
+    with i.get(7).open() as f:
+        assert f.read() == b"bye"
+    assert dict(i.get_group("/0/0").read_many([3, 4])) == {"3": b"bye", "4": b"bye"}
+
+def test_recompress(little_index_filestore):
+    pytest.importorskip("lz4")
+    for i in range(0, 10):
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    little_index_filestore.compact()
+    group = little_index_filestore.get_group("/0/0")
+
+    reports = little_index_filestore.recompress(codec="lz4", source_codecs=["gzip"])
+    assert [report.group for report in reports] == [group]
+    assert group.codec == "lz4"
+    assert sorted(os.listdir("/tmp/filestore/0")) == ["0.lz4.tar", "0.lz4.tar.idx"]
+    with little_index_filestore.get(5).open() as f:
+        assert f.read() == b"hi"
+
+    assert little_index_filestore.recompress(codec="lz4") == []
+    group.recompress(codec="none")
+    assert sorted(os.listdir("/tmp/filestore/0")) == ["0.tar", "0.tar.idx"]
+    i = Index(path="/tmp/filestore", dimensions=[1,1,1])
+    assert dict(i.get_group("/0/0").read_all())["9"] == b"hi"
+
+def test_validate_checksums(little_index_filestore):
+    for i in range(0, 20):
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    little_index_filestore.get_group("/0/0").compact(codec="none")
+    little_index_filestore.get_group("/0/1").compact(codec="gzip")
+    assert little_index_filestore.validate(workers=2) is True
+    assert little_index_filestore.validate(quick=True) is True
+
+    # corrupt one member without changing its size; only the full pass notices
+    offset, _ = json.load(open("/tmp/filestore/0/0.tar.idx"))["members"]["3"]
+    with open("/tmp/filestore/0/0.tar", "r+b") as f:
+        f.seek(offset)
+        f.write(b"ho")
+    assert little_index_filestore.validate(quick=True) is True
+    result = little_index_filestore.validate()
+    assert list(result) == ["/0/0"]
+    assert "checksum" in str(result["/0/0"])
+
+def test_compact_reports_failures(little_index_filestore):
+    for i in range(0, 20):
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    # an archive that cannot be written fails its group only
+    broken = little_index_filestore.get_group("/0/0")
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    broken._write_archive = fail
+    reports = sorted(little_index_filestore.compact(codec="none"), key=lambda report: report.group.uri)
+    assert [report.ok for report in reports] == [False, True]
+    assert isinstance(reports[0].error, OSError)
+    assert not broken.is_tarball
+    assert little_index_filestore.get_group("/0/1").is_tarball
+    assert os.path.exists("/tmp/filestore/0/0/9.bin")
+    shutil.rmtree("/tmp/filestore")
+
+def test_groups_change_while_iterated(little_index_filestore):
+    for i in (0, 10, 20):
+        little_index_filestore.put(i, filename="tests/data/12345678.bin")
+    # a watcher thread can add and remove groups at any point of a loop over them
+    seen = []
+    for group_uri, group in little_index_filestore.groups.items():
+        seen.append(group_uri)
+        little_index_filestore.groups.pop("/0/2", None)
+        little_index_filestore.groups["/0/5"] = Group(little_index_filestore, "/0/5")
+    assert seen == ["/0/0", "/0/1", "/0/2"]
+    for group in little_index_filestore.groups.values():
+        little_index_filestore.groups.pop(group.uri)
+    assert len(little_index_filestore.groups) == 0
+
+    little_index_filestore.sync()
+    little_index_filestore.groups["/0/3"] = Group(little_index_filestore, "/0/3")
+    little_index_filestore.groups.sort()
+    assert list(little_index_filestore.groups) == ["/0/0", "/0/1", "/0/2", "/0/3"]
+    shutil.rmtree("/tmp/filestore")
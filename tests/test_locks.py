@@ -0,0 +1,110 @@
+import os
+import shutil
+import threading
+import multiprocessing
+
+import pytest
+
+from nested_filestore.index import Index
+from nested_filestore.locks import GroupLocks
+
+
+def test_group_locks_exclusive():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    locks = GroupLocks("/tmp/filestore", enabled=True)
+    order = []
+
+    def compactor():
+        with locks.exclusive("/0/0"):
+            order.append("exclusive")
+
+    with locks.shared("/0/0"), locks.shared("/0/0"):
+        # shared holders do not block each other, but do block an exclusive lock
+        thread = threading.Thread(target=compactor)
+        thread.start()
+        thread.join(timeout=0.2)
+        assert thread.is_alive()
+        order.append("shared")
+    thread.join()
+
+    assert order == ["shared", "exclusive"]
+    assert os.path.exists("/tmp/filestore/.locks/0-0.lock")
+    stats = locks.stats
+    assert stats["shared"]["acquired"] == 2
+    assert stats["exclusive"]["contended"] == 1
+    assert stats["exclusive"]["wait_seconds"] > 0
+
+def test_group_locks_disabled():
+    locks = GroupLocks("/tmp/does-not-exist", enabled=False)
+    with locks.exclusive("/0/0"):
+        pass
+    locks.acquire("/0/0")()
+    assert locks.stats["exclusive"]["acquired"] == 0
+    assert not os.path.exists("/tmp/does-not-exist")
+
+def _put(barrier, results):
+    index = Index(path="/tmp/filestore", dimensions=[1, 1, 1], locking=True)
+    barrier.wait()
+    try:
+        index.put(5, filename="tests/data/12345678.bin")
+        results.put("ok")
+    except ValueError:
+        results.put("conflict")
+
+def test_put_across_processes():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    os.makedirs("/tmp/filestore")
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(4)
+    results = context.Queue()
+    processes = [context.Process(target=_put, args=(barrier, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    outcomes = sorted(results.get() for _ in processes)
+    assert outcomes == ["conflict", "conflict", "conflict", "ok"]
+
+def test_put_after_compaction_elsewhere():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    writer = Index(path="/tmp/filestore", dimensions=[1, 1, 1], locking=True)
+    writer.put(0, filename="tests/data/12345678.bin")
+
+    compactor = Index(path="/tmp/filestore", dimensions=[1, 1, 1], locking=True)
+    for i in range(1, 10):
+        compactor.put(i, filename="tests/data/12345678.bin")
+    assert compactor.get_group("/0/0").compact(codec="none")
+
+    # the writer's view says the group is a directory missing nothing it knows of
+    with pytest.raises(ValueError):
+        writer.put(5, filename="tests/data/12345678.bin", overwrite=True)
+    assert not os.path.exists("/tmp/filestore/0/0")
+
+def _open_lock_files():
+    count = 0
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            count += "/.locks/" in os.readlink(f"/proc/self/fd/{fd}")
+        except OSError:
+            continue
+    return count
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_put_many_bounds_held_locks():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    index = Index(path="/tmp/filestore", dimensions=[1, 1, 1], locking=True)
+    held = []
+    transfer = index._transfer
+
+    def counting_transfer(*args):
+        held.append(_open_lock_files())
+        transfer(*args)
+
+    index._transfer = counting_transfer
+    # one item in each of 200 groups: only the groups with transfers in flight hold a lock
+    result = index.put_many([(i * 10, "tests/data/12345678.bin") for i in range(0, 200)], workers=2)
+    assert len(result.succeeded) == 200
+    assert max(held) <= 2 * 4
+    assert _open_lock_files() == 0
+    shutil.rmtree("/tmp/filestore")
@@ -0,0 +1,46 @@
+import shutil
+
+from nested_filestore import NestedFilestore
+from nested_filestore.metrics import Metrics
+
+
+def test_metrics_disabled():
+    metrics = Metrics()
+    metrics.count("a")
+    with metrics.timer("b"):
+        pass
+    assert metrics.snapshot == {"counters": {}, "timers": {}}
+
+def test_metrics_listener():
+    metrics = Metrics(enabled=True)
+    seen = []
+    metrics.listeners.append(lambda kind, name, value: seen.append((kind, name)))
+    metrics.count("a", 2)
+    with metrics.timer("b"):
+        pass
+    assert seen == [("count", "a"), ("time", "b")]
+    assert metrics.snapshot["counters"] == {"a": 2}
+    assert metrics.snapshot["timers"]["b"]["count"] == 1
+
+def test_index_metrics():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    filestore = NestedFilestore("/tmp/filestore", [1, 1, 1], metrics=True)
+    for i in range(0, 10):
+        filestore.put(i, filename="tests/data/12345678.bin")
+    filestore.put(12, filename="tests/data/12345678.bin")
+    filestore.compact(codec="none")
+    assert filestore.exists(3)
+    with filestore.get(3) as f:
+        f.read()
+    with filestore.get(12) as f:
+        f.read()
+
+    stats = filestore.index.stats
+    timers = stats["metrics"]["timers"]
+    assert timers["put"]["count"] == 11
+    assert timers["compact.group"]["count"] == 1
+    assert timers["open.tarball"]["count"] == 1
+    assert timers["open.loose"]["count"] == 1
+    assert timers["archive.open"]["count"] == 1
+    assert stats["metrics"]["counters"]["which_group"] > 0
+    assert stats["handles"]["misses"] == 1
@@ -1,5 +1,9 @@
+import os
+import shutil
+
 import pytest
 
+from nested_filestore import NestedFilestore
 from nested_filestore.item import Item
 
 
@@ -59,3 +63,98 @@ def test_filestore_min_max(filestore):
     filestore.put(12345678, "tests/data/12345678.bin")
     assert filestore.index.min == "12"
     assert filestore.index.max == "12345678"
+
+def test_get_many():
+    filestore = NestedFilestore("tests/data/filestore-1-1-1", [1, 1, 1])
+    requested = [420, 11, 9, 0, 11, 15]
+    results = list(filestore.get_many(requested))
+    assert [identifier for identifier, _ in results] == requested
+    assert dict(results) == {420: b"hi", 11: b"hi", 9: None, 0: b"hi", 15: b"hi"}
+
+    unordered = list(filestore.get_many(requested, ordered=False))
+    assert sorted(unordered, key=lambda result: result[0]) == sorted(results, key=lambda result: result[0])
+
+def test_exists_many():
+    filestore = NestedFilestore("tests/data/filestore-1-1-1", [1, 1, 1])
+    assert list(filestore.exists_many([0, 2, 11, 421])) == [(0, True), (2, False), (11, True), (421, False)]
+
+def test_ingest_filesystem(filestore):
+    shutil.rmtree("/tmp/filestore-ingest", ignore_errors=True)
+    os.makedirs("/tmp/filestore-ingest/a")
+    for identifier in [5, 1234, 12345678]:
+        shutil.copy("tests/data/12345678.bin", f"/tmp/filestore-ingest/a/{identifier}.bin")
+
+    result = filestore.ingest_filesystem("/tmp/filestore-ingest")
+    assert result.ok
+    assert sorted(result.succeeded, key=int) == ["5", "1234", "12345678"]
+    assert not os.path.exists("/tmp/filestore-ingest/a/5.bin")
+    with filestore.get(1234) as f:
+        assert f.read() == b"hi"
+
+def test_writer_is_atomic(filestore):
+    fh = filestore.writer(12345678)
+    fh.write(b"partial")
+    assert not filestore.exists(12345678)
+    assert not os.path.exists("/tmp/filestore/012/345/12345678.bin")
+    fh.close()
+    assert filestore.exists(12345678)
+    with filestore.get(12345678) as f:
+        assert f.read() == b"partial"
+
+    with pytest.raises(RuntimeError):
+        with filestore.writer(12345679) as fh:
+            fh.write(b"never")
+            raise RuntimeError()
+    assert not filestore.exists(12345679)
+    assert os.listdir("/tmp/filestore/012/345") == ["12345678.bin"]
+
+def test_fsync_policy():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    filestore = NestedFilestore("/tmp/filestore", [3, 3, 3], fsync="dir")
+    with filestore.writer(5) as fh:
+        fh.write(b"synced")
+    filestore.put(6, "tests/data/12345678.bin")
+    assert filestore.exists(5) and filestore.exists(6)
+    with pytest.raises(ValueError):
+        NestedFilestore("/tmp/filestore", [3, 3, 3], fsync="Dir")
+
+def test_get_buffer(filestore):
+    filestore.put(12345678, "tests/data/12345678.bin")
+    buffer = filestore.get_buffer(12345678)
+    assert buffer.readonly
+    assert bytes(buffer) == b"hi"
+
+    for identifier in range(1000, 2000):
+        filestore.put(identifier, "tests/data/12345679.bin")
+    filestore.compact(codec="none")
+    buffer = filestore.get_buffer(1234)
+    assert buffer.readonly
+    assert bytes(buffer) == b"bye"
+    assert pytest.raises(ValueError, filestore.get_buffer, 2000)
+
+def test_get_buffer_tarball():
+    filestore = NestedFilestore("tests/data/filestore-1-1-1", [1, 1, 1])
+    assert bytes(filestore.get_buffer(11)) == b"hi"
+
+def test_iter_range():
+    filestore = NestedFilestore("tests/data/filestore-1-1-1", [1, 1, 1])
+    results = list(filestore.iter_range(0, 101))
+    assert [identifier for identifier, _ in results] == [0, 1] + list(range(10, 20)) + [50, 100]
+    assert all(data == b"hi" for _, data in results)
+    assert list(filestore.iter_range(0, 101, readahead=0)) == results
+
+    assert list(filestore.iter_range(15, 18)) == [(15, b"hi"), (16, b"hi"), (17, b"hi")]
+    assert list(filestore.iter_range(0, 4, include_missing=True)) == [(0, b"hi"), (1, b"hi"), (2, None), (3, None)]
+
+    # stopping early releases the read-ahead thread
+    stream = filestore.iter_range(0, 500, readahead=2)
+    assert next(stream) == (0, b"hi")
+    stream.close()
+
+def test_iter_range_gzip(filestore):
+    for identifier in range(2000, 3000):
+        filestore.put(identifier, "tests/data/12345679.bin")
+    filestore.compact()
+    results = list(filestore.iter_range(1990, 3010))
+    assert [identifier for identifier, _ in results] == list(range(2000, 3000))
+    assert all(data == b"bye" for _, data in results)
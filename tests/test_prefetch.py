@@ -0,0 +1,54 @@
+import shutil
+
+from nested_filestore import NestedFilestore
+
+
+def make_filestore():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    filestore = NestedFilestore("/tmp/filestore", [1, 1, 1])
+    for i in range(0, 35):
+        filestore.put(i, filename="tests/data/12345678.bin")
+    filestore.compact(codec="gzip")
+    # start with no archive open
+    filestore.index.handles.clear()
+    return filestore
+
+def test_prefetch_sequential():
+    filestore = make_filestore()
+    prefetcher = filestore.prefetch(depth=2)
+    for i in range(0, 3):
+        with filestore.get(i) as f:
+            assert f.read() == b"hi"
+    prefetcher.wait()
+
+    # groups 1 and 2 were opened ahead of the reader
+    assert prefetcher.stats["scheduled"] == 2
+    assert prefetcher.stats["warmed"] == 2
+    assert len(filestore.index.handles) == 3
+    misses = filestore.index.handles.stats["misses"]
+    for i in range(3, 30):
+        with filestore.get(i) as f:
+            assert f.read() == b"hi"
+    assert filestore.index.handles.stats["misses"] == misses
+    assert prefetcher.stats["hits"] == 2
+    filestore.close()
+    shutil.rmtree("/tmp/filestore")
+
+def test_prefetch_random_and_budget():
+    filestore = make_filestore()
+    prefetcher = filestore.prefetch(depth=2, max_bytes=1)
+    for i in (20, 3, 11, 1):
+        filestore.get(i).close()
+    assert prefetcher.stats["scheduled"] == 0
+
+    for i in range(0, 3):
+        filestore.get(i).close()
+    prefetcher.wait()
+    assert prefetcher.stats["bytes_advised"] == 2
+    # group 2, warmed but not reached yet, uses up the budget, so group 3 waits
+    for i in range(3, 11):
+        filestore.get(i).close()
+    assert prefetcher.stats["hits"] == 1
+    assert prefetcher.stats["over_budget"] == 1
+    filestore.close()
+    shutil.rmtree("/tmp/filestore")
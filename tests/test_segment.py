@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from nested_filestore.index import Index
+
+
+def test_segment_put_and_read(segment_filestore):
+    segment_filestore.put(3, filename="tests/data/12345678.bin")
+    with segment_filestore.writer(4) as f:
+        f.write(b"bye")
+
+    # no file per item, just the segment and its index log
+    assert sorted(os.listdir("/tmp/filestore/0")) == ["0.seg", "0.seg.idx"]
+    with segment_filestore.get(3) as f:
+        assert f.read() == b"hi"
+    assert bytes(segment_filestore.get_buffer(4)) == b"bye"
+    assert dict(segment_filestore.get_many([4, 3, 5])) == {4: b"bye", 3: b"hi", 5: None}
+
+    with pytest.raises(ValueError):
+        segment_filestore.put(3, filename="tests/data/12345679.bin")
+    segment_filestore.put(3, filename="tests/data/12345679.bin", overwrite=True)
+    with segment_filestore.get(3) as f:
+        assert f.read() == b"bye"
+
+    # another instance reads the segment back, and only the last append counts
+    reopened = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    assert reopened.get_group("/0/0").is_segment
+    assert list(reopened.get_group("/0/0").identifiers) == [3, 4]
+    with reopened.get(3).open() as f:
+        assert f.read() == b"bye"
+
+def test_segment_writer_discards_on_error(segment_filestore):
+    with pytest.raises(RuntimeError):
+        with segment_filestore.writer(5) as f:
+            f.write(b"partial")
+            raise RuntimeError("failed")
+    assert not segment_filestore.exists(5)
+    segment_filestore.put(5, filename="tests/data/12345678.bin")
+    assert segment_filestore.exists(5)
+
+def test_segment_sees_appends_from_another_index(segment_filestore):
+    segment_filestore.put(1, filename="tests/data/12345678.bin")
+    other = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False, storage="segment")
+    other.put(2, filename="tests/data/12345679.bin")
+
+    assert not segment_filestore.exists(2)
+    segment_filestore.index.reload_group("/0/0")
+    assert segment_filestore.exists(2)
+    with segment_filestore.get(2) as f:
+        assert f.read() == b"bye"
+
+@pytest.mark.parametrize("codec", ["none", "gzip"])
+def test_segment_compact(segment_filestore, codec):
+    for i in range(0, 10):
+        segment_filestore.put(i, filename="tests/data/12345678.bin")
+    reports = segment_filestore.compact(codec=codec)
+    assert len(reports) == 1
+
+    tarball = "/tmp/filestore/0/0.tar" if codec == "none" else "/tmp/filestore/0/0.tgz"
+    assert os.path.isfile(tarball)
+    assert not os.path.exists("/tmp/filestore/0/0.seg")
+    assert not os.path.exists("/tmp/filestore/0/0.seg.idx")
+    assert segment_filestore.index.validate() is True
+    with segment_filestore.get(7) as f:
+        assert f.read() == b"hi"
+
+    reopened = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    assert reopened.get_group("/0/0").codec == codec
+    assert reopened.validate() is True
+
+def test_segment_compact_rewrites_superseded_items(segment_filestore):
+    for i in range(0, 10):
+        segment_filestore.put(i, filename="tests/data/12345678.bin")
+    segment_filestore.put(2, filename="tests/data/12345679.bin", overwrite=True)
+    segment_filestore.compact(codec="none")
+
+    assert os.path.isfile("/tmp/filestore/0/0.tar")
+    assert not os.path.exists("/tmp/filestore/0/0.seg")
+    assert segment_filestore.index.validate() is True
+    with segment_filestore.get(2) as f:
+        assert f.read() == b"bye"
+
+def test_segment_writer_with_locking(segment_filestore):
+    index = Index(path="/tmp/filestore", dimensions=[1, 1, 1], storage="segment", locking=True)
+    # an open writer holds no lock, so other puts to its group go ahead
+    writer = index.put(1, filehandle=True)
+    writer.write(b"hi")
+    index.put(2, filename="tests/data/12345679.bin")
+    writer.close()
+    assert list(index.get_group("/0/0").identifiers) == [1, 2]
+
+    # the segment is checked under the lock when the writer closes
+    other = Index(path="/tmp/filestore", dimensions=[1, 1, 1], storage="segment", locking=True)
+    duplicate = other.put(3, filehandle=True)
+    index.put(3, filename="tests/data/12345678.bin")
+    duplicate.write(b"bye")
+    with pytest.raises(ValueError):
+        duplicate.close()
+    with index.get(3).open() as f:
+        assert f.read() == b"hi"
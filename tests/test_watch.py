@@ -0,0 +1,83 @@
+import os
+import time
+import shutil
+
+import pytest
+
+from nested_filestore.index import Index
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+@pytest.mark.parametrize("backend", ["inotify", "poll"])
+def test_watch(backend):
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    os.makedirs("/tmp/filestore")
+    reader = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    watcher = reader.watch(backend=backend, interval=0.05)
+    assert watcher.backend == backend
+
+    writer = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    for i in range(0, 10):
+        writer.put(i, filename="tests/data/12345678.bin")
+    writer.put(123, filename="tests/data/12345679.bin")
+    assert wait_until(lambda: reader.exists(9) and reader.exists(123))
+    assert not reader.get_group("/0/0").is_tarball
+
+    os.remove("/tmp/filestore/1/2/123.bin")
+    assert wait_until(lambda: not reader.exists(123))
+
+    writer.get_group("/0/0").compact(codec="none")
+    assert wait_until(lambda: reader.get_group("/0/0").is_tarball)
+    with reader.get(4).open() as f:
+        assert f.read() == b"hi"
+
+    reader.close()
+    assert reader.watcher is None
+
+@pytest.mark.parametrize("backend", ["inotify", "poll"])
+def test_watch_segment(backend):
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    os.makedirs("/tmp/filestore")
+    reader = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    reader.watch(backend=backend, interval=0.05)
+
+    writer = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False, storage="segment")
+    writer.put(3, filename="tests/data/12345678.bin")
+    assert wait_until(lambda: reader.exists(3))
+    assert reader.get_group("/0/0").is_segment
+    for i in range(0, 10):
+        if i != 3:
+            writer.put(i, filename="tests/data/12345679.bin")
+    assert wait_until(lambda: reader.exists(9))
+    with reader.get(9).open() as f:
+        assert f.read() == b"bye"
+
+    writer.get_group("/0/0").compact(codec="none")
+    assert wait_until(lambda: reader.get_group("/0/0").is_tarball)
+    with reader.get(3).open() as f:
+        assert f.read() == b"hi"
+    reader.close()
+
+def test_sync_notices_compaction():
+    shutil.rmtree("/tmp/filestore", ignore_errors=True)
+    reader = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    writer = Index(path="/tmp/filestore", dimensions=[1, 1, 1], manifest=False)
+    for i in range(0, 10):
+        writer.put(i, filename="tests/data/12345678.bin")
+    writer.put(25, filename="tests/data/12345678.bin")
+    reader.sync()
+    assert not reader.get_group("/0/0").is_tarball
+
+    writer.get_group("/0/0").compact(codec="none")
+    shutil.rmtree("/tmp/filestore/0/2")
+    reader.sync()
+    assert reader.get_group("/0/0").is_tarball
+    assert "/0/2" not in reader.groups
+    assert not reader.exists(25)